@@ -1,12 +1,20 @@
 #!/bin/python
 import sys
-import unittest
-import shutil
+import io
 import os
 import re
+import json
+import hashlib
+import errno
+import stat
+import time
 from enum import Enum
-from itertools import permutations
-from argparse import Namespace, ArgumentParser, FileType
+from itertools import count
+from math import factorial
+from collections import Counter, OrderedDict, deque
+from functools import partial, lru_cache
+# argparse, unittest, tempfile, asyncio and concurrent.futures are imported where they
+# are used since this runs from shell rc files and most runs never need them
 # TODO: i need to change how the escaping works for comments and {}
 # as it doesnt allow you to type a { after a \
 r"""config:documentation
@@ -20,11 +28,25 @@ abbr(la,ls -a) creates an abbreviation and falls back to aliases if abbreviation
 abbr(sh0, shutdown now) -> permutate key
 set_env(d,frog) sets environment variable
 set_motion_mode(vi) parameter can be vi, emacs or normal, not supported by nushell
+set_path_mode(combined) parameter can be separate (the default) for one statement per add_path,
+    combined to drop duplicate paths and add the rest in one statement or guarded to also skip paths
+    already in PATH when the file is sourced
+set_alias_mode(batched) parameter can be separate (the default) or batched to define aliases with as few
+    commands as the shell allows, which makes sourcing the generated file faster
 add_path(path)
 
 compile_path(shell, path)
+compile_env_path(shell, path) writes the environment variables and PATH of the shell to path on their own,
+    source it from a file every shell reads like ~/.profile or ~/.zshenv. the compile_path file then only has
+    what interactive shells use, behind a check that skips it everywhere else
+source(path, other_path) reads other configs, relative paths are relative to the file doing the sourcing
+source_once(path) does the same but skips files that were already sourced
+a file sourcing itself, directly or through other files, is reported as an error
 
 to reference env variable in an expression use {VAR_NAME} escape \{ \} if you want to use them
+set_variable_mode(folded) parameter can be runtime (the default) or folded to replace {VAR_NAME} with the
+    value set_env gave it when that value doesn't reference anything the shell has to expand, variables are
+    then written after the ones they reference and variables referencing each other are reported as errors
 
 -> is called a directive and goes after a command to change it's writing behaviour in preprocessing
 -> permutate key is will permutate a key so
@@ -48,13 +70,17 @@ abbr(tgi, git)
 abbr(tig, git)
 
 both of these directives only work with commands with two parameters a key value pair if you will.
+with --typo-table aliases and abbreviations using them are written once to a table that a command not found
+    hook looks typos up in, bash, zsh and fish then start as fast however many permutations there are while
+    nushell, murex and xonsh still get every permutation
 
 """
 
 CURRENT_VERSION = 'v1.1'
 
 
-def parse_args(args) -> Namespace:
+def parse_args(args):
+    from argparse import ArgumentParser, FileType
     parser = ArgumentParser(
         prog='easy-env-config',
         description='this is a simple program for setting up environment variables and alises/abbrevations for users who frequently switch shells or are trying out a new shell')
@@ -65,6 +91,54 @@ def parse_args(args) -> Namespace:
                         action='store_true', help="runs programs tests")
     parser.add_argument('-p', '--print',
                         action='store_true', help="prints the resulting config on a per shell bases without writing to disk")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="ignore and don't update the build cache, always rebuild every file")
+    parser.add_argument('--verbose', action='store_true',
+                        help="reports which files and outputs were reused from the build cache")
+    parser.add_argument('--fsync', choices=[mode.value for mode in FsyncMode], default=FsyncMode.BATCH.value,
+                        help="when to fsync changed outputs, batch syncs all of them together before renaming")
+    parser.add_argument('--max-permutation-key-length', type=int, default=DEFAULT_PERMUTATION_ENGINE.max_key_length,
+                        help="longest key the permutation directives accept")
+    parser.add_argument('--max-permutations', type=int, default=DEFAULT_PERMUTATION_ENGINE.max_permutations,
+                        help="most entries a single permutation directive may generate")
+    parser.add_argument('--plugin-dir', default=PLUGIN_DIR,
+                        help="directory of python files that add shells, see load_plugins")
+    parser.add_argument('--typo-table', action='store_true',
+                        help="write the aliases and abbreviations of permutation directives once to a typo table "
+                             "that bash, zsh and fish look up when a command isn't found, instead of every permutation. "
+                             "bash and zsh run that hook in a subshell, so values using cd, export, source and other "
+                             "builtins that change the shell still get every permutation there")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="number of shells rendered and written at the same time on threads, "
+                             "helps when writing is slow like on a network mounted home directory")
+    parser.add_argument('--prefetch', type=int, default=0, metavar='N',
+                        help=f"reads sourced files with up to N threads before preprocessing and keeps each in memory until it is used, for slow mounts (try {PREFETCH_WORKERS}, default 0 streams them one at a time)")
+    parser.add_argument('--benchmark', choices=sorted(BENCHMARKS),
+                        help="runs one of the benchmarks and prints the results")
+    parser.add_argument('--benchmark-output',
+                        help="appends the benchmark results as a json line to this file to track them over time")
+    parser.add_argument('--benchmark-filter',
+                        help="only runs the suite scenarios whose name contains this")
+    parser.add_argument('--benchmark-baseline',
+                        help="json file of per stage timings the suite is compared against, created if missing")
+    parser.add_argument('--benchmark-threshold', type=float, default=0.25,
+                        help="how much slower than the baseline a stage may get, 0.25 is 25%%")
+    parser.add_argument('--update-baseline', action='store_true',
+                        help="stores the suite results as the new baseline instead of comparing")
+    parser.add_argument('--timings', action='store_true',
+                        help="prints the time spent in every stage, the lines generated by directives and the bytes written to stderr")
+    parser.add_argument('--timings-format', choices=['text', 'json'], default='text',
+                        help="how --timings and --trace-memory print their report")
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="adds the peak memory use to the timings, tracing memory slows the run down")
+    parser.add_argument('--profile', metavar='FILE',
+                        help="writes a cProfile dump of the run to FILE")
+    parser.add_argument('-w', '--watch', action='store_true',
+                        help="keeps running and rebuilds whenever the config or a file it sources changes")
+    parser.add_argument('--serve', metavar='ADDRESS',
+                        help="runs a compile server on a unix socket path, a port or host:port on localhost")
+    parser.add_argument('--server-cache-size', type=int, default=256, metavar='N',
+                        help="compile results the server keeps (default 256)")
     parser.add_argument('file', nargs='?', type=FileType('r'),
                         help='config file')
     return parser.parse_args(args)
@@ -76,24 +150,541 @@ def read_file(path) -> str:
     return lines
 
 
+def iter_file_lines(path):
+    with open(path, 'r') as file:
+        yield from file
+
+
+def read_bytes(path) -> bytes:
+    with open(path, 'rb') as file:
+        return file.read()
+
+
+# the lines of a file already read into memory, as iterating the open file gives them
+def iter_data_lines(data: bytes):
+    return iter(io.StringIO(data.decode(), newline=None))
+
+
 def empty(collection):
     return len(collection) == 0
 
 
+# wall and cpu time per pipeline stage, a stage's time excludes the stages it
+# pulls from so the lazy pipeline stages that run interleaved are told apart
+class Timings:
+    enabled = True
+
+    def __init__(self):
+        import threading
+        self.stages = {}
+        self.files = {}
+        self.counters = {}
+        self.peak_memory = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _stack(self) -> list:
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _enter(self, name):
+        self._stack().append([name, time.perf_counter(), time.thread_time(), 0.0, 0.0])
+
+    def _exit(self):
+        stack = self._stack()
+        name, wall, cpu, child_wall, child_cpu = stack.pop()
+        wall = time.perf_counter() - wall
+        cpu = time.thread_time() - cpu
+        if stack:
+            stack[-1][3] += wall
+            stack[-1][4] += cpu
+        self._add(self.stages, name, wall - child_wall, cpu - child_cpu)
+
+    def _add(self, table, name, wall, cpu):
+        with self._lock:
+            totals = table.setdefault(name, [0.0, 0.0, 0])
+            totals[0] += wall
+            totals[1] += cpu
+            totals[2] += 1
+
+    def stage(self, name):
+        return _TimedStage(self, name)
+
+    def iterate(self, name, iterable):
+        iterator = iter(iterable)
+        while True:
+            self._enter(name)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self._exit()
+            yield item
+
+    # the time spent producing everything of one file, including what it sources
+    def iterate_file(self, path, iterable):
+        iterator = iter(iterable)
+        while True:
+            wall, cpu = time.perf_counter(), time.thread_time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self._add(self.files, path, time.perf_counter() -
+                          wall, time.thread_time() - cpu)
+            yield item
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def to_json(self) -> dict:
+        def table(rows):
+            return {name: {'wall_ms': wall * 1000, 'cpu_ms': cpu * 1000, 'calls': calls}
+                    for name, (wall, cpu, calls) in rows.items()}
+        return {'stages': table(self.stages), 'files': table(self.files),
+                'counters': self.counters, 'peak_memory_bytes': self.peak_memory}
+
+    def report(self) -> str:
+        out = [f'{"stage":<48}{"wall ms":>10}{"cpu ms":>10}']
+        for title, rows in [(None, self.stages), ('sourced files, including what they source', self.files)]:
+            if title and rows:
+                out.append(title)
+            for name, (wall, cpu, _) in rows.items():
+                out.append(f'{name:<48}{wall * 1000:>10.2f}{cpu * 1000:>10.2f}')
+        for name, amount in self.counters.items():
+            out.append(f'{name}: {amount}')
+        if self.peak_memory is not None:
+            out.append(f'peak memory: {self.peak_memory / 1024:.1f} KiB')
+        return '\n'.join(out)
+
+
+class _TimedStage:
+    __slots__ = ('timings', 'name')
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.timings._enter(self.name)
+
+    def __exit__(self, *exc_info):
+        self.timings._exit()
+
+
+class _NullStage:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+# used while instrumentation is off, the pipeline asks for its hooks once per
+# stage or file and gets back the iterable it passed in, so nothing is added
+# per line
+class DisabledTimings:
+    enabled = False
+    _stage = _NullStage()
+
+    def stage(self, name):
+        return self._stage
+
+    def iterate(self, name, iterable):
+        return iterable
+
+    def iterate_file(self, path, iterable):
+        return iterable
+
+    def count(self, name, amount=1):
+        pass
+
+
+# replaced by main when --timings or --trace-memory is passed
+TIMINGS = DisabledTimings()
+
+
+class _BinarySink:
+    def __init__(self, sink):
+        self.sink = sink
+
+    def write(self, text: str):
+        self.sink.write(text.encode())
+
+
+def text_sink(sink):
+    if isinstance(sink, (io.RawIOBase, io.BufferedIOBase)):
+        return _BinarySink(sink)
+    return sink
+
+
+def _write_lines(sink, lines):
+    separator = ''
+    for line in lines:
+        sink.write(f'{separator}{line}')
+        separator = '\n'
+
+
 class MotionMode(Enum):
     VI = "vi"
     EMACS = "emacs"
     NORMAL = "normal"
 
 
+# separate writes one statement per add_path, combined drops duplicates and
+# writes one statement for all of them and guarded also skips the ones already
+# in PATH when the file is sourced, where the shell can check that cheaply
+class PathMode(Enum):
+    SEPARATE = "separate"
+    COMBINED = "combined"
+    GUARDED = "guarded"
+
+
+# separate writes one alias command per alias, batched defines them with as few
+# builtin calls as the shell allows so sourcing the file is faster
+class AliasMode(Enum):
+    SEPARATE = "separate"
+    BATCHED = "batched"
+
+
+# aliases defined by one alias builtin call in batched mode
+ALIAS_BATCH_SIZE = 100
+
+
+# runtime leaves every {VAR} for the shell to expand when the file is sourced,
+# folded inlines the variables set in the config whose values are known when
+# compiling and writes the rest in the order they depend on each other
+class VariableMode(Enum):
+    RUNTIME = "runtime"
+    FOLDED = "folded"
+
+
+# the characters that decide how a value is quoted, as bits of its traits
+SPACE = 1
+PIPE = 2
+AMPERSAND = 4
+REDIRECT = 8
+SINGLE_QUOTE = 16
+DOUBLE_QUOTE = 32
+PIPELINE = PIPE | AMPERSAND | REDIRECT
+QUOTES = SINGLE_QUOTE | DOUBLE_QUOTE
+
+_TRAITS = {' ': SPACE, '\t': SPACE, '|': PIPE, '&': AMPERSAND, '<': REDIRECT, '>': REDIRECT,
+           "'": SINGLE_QUOTE, '"': DOUBLE_QUOTE}
+_TRAITS_PATTERN = re.compile(f'[{re.escape("".join(_TRAITS))}]')
+
+
+# scans a value once for every character that matters for quoting, the shells
+# rendering the same value share the result
+@lru_cache(maxsize=1 << 16)
+def classify(value: str) -> int:
+    traits = 0
+    for char in _TRAITS_PATTERN.findall(value):
+        traits |= _TRAITS[char]
+    return traits
+
+
+# builtins that change the shell running them, see Shell.TYPO_HOOK_SUBSHELL
+STATE_BUILTINS = frozenset((
+    '.', 'alias', 'bindkey', 'builtin', 'cd', 'declare', 'eval', 'exec', 'exit', 'export', 'hash',
+    'local', 'popd', 'pushd', 'readonly', 'set', 'setopt', 'shopt', 'source', 'trap', 'typeset',
+    'ulimit', 'umask', 'unalias', 'unset', 'unsetopt'))
+_COMMAND_SEPARATOR_PATTERN = re.compile(r'[;&|(){}]+')
+
+
+# whether any command of value starts with one of STATE_BUILTINS
+def changes_shell_state(value: str) -> bool:
+    return any(words[0] in STATE_BUILTINS for words in
+               (command.split(maxsplit=1) for command in _COMMAND_SEPARATOR_PATTERN.split(value))
+               if words)
+
+
+def is_quoted(value: str) -> bool:
+    return len(value) > 1 and value[0] == value[-1] and value[0] in '"\''
+
+
+# how a shell quotes values: for every context the traits that make a value
+# need quotes, or None when every value does, and the quote used, and for
+# every quote the characters escaped inside it
+class EscapeTable:
+    def __init__(self, rules: dict, escapes: dict):
+        self.rules = rules
+        self._translations = {quote: str.maketrans(characters)
+                              for quote, characters in escapes.items()}
+
+    # values the user already wrapped in quotes are kept as they are
+    def quote(self, context, value: str) -> str:
+        traits, quote = self.rules[context]
+        if traits is not None and not classify(value) & traits or is_quoted(value):
+            return value
+        return self.quoted(quote, value)
+
+    def quoted(self, quote, value: str) -> str:
+        return f'{quote}{self.escape(quote, value)}{quote}'
+
+    # for values written between quotes that are already there
+    def escape(self, quote, value: str) -> str:
+        return value.translate(self._translations[quote])
+
+
+POSIX_ESCAPES = EscapeTable(
+    {'alias': (SPACE | PIPELINE | QUOTES, '"'),
+     'env': (SPACE | PIPELINE | QUOTES, '"'),
+     'path': (SPACE | PIPELINE | QUOTES, '"')},
+    {'"': {'"': '\\"', '\\': '\\\\', '`': '\\`'}, "'": {"'": "'\\''"}})
+
+# fish joins the words of an alias, abbreviation or variable itself, so only
+# pipelines and quotes need quoting there
+FISH_ESCAPES = EscapeTable(
+    {'alias': (PIPELINE | QUOTES, '"'),
+     'abbr': (PIPELINE | QUOTES, "'"),
+     'env': (PIPELINE | QUOTES, '"'),
+     'path': (SPACE | PIPELINE | QUOTES, '"')},
+    {'"': {'"': '\\"', '\\': '\\\\'}, "'": {"'": "\\'", '\\': '\\\\'}})
+
+# a bare word would run as a command, so nushell variables are always strings
+NU_ESCAPES = EscapeTable(
+    {'env': (None, '"')},
+    {'"': {'"': '\\"', '\\': '\\\\'}})
+
+
+_VARIABLE_PATTERN = re.compile(r'(?<!\\){([^}]*)}')
+
+
+# a value parsed once into literal and {VAR} segments, every shell renders from
+# the same segments and the result is memoized per variable format so shells
+# that format variables the same way share one rendered string
+class Template:
+    __slots__ = ('text', 'segments', '_rendered')
+
+    def __init__(self, text: str):
+        self.text = text
+        self._rendered = None
+        if not self.needed(text):
+            self.segments = None
+            return
+        # literals at even and variable names at odd indices
+        self.segments = tuple(_VARIABLE_PATTERN.split(text))
+
+    # plain text renders to itself in every shell
+    @staticmethod
+    def needed(text) -> bool:
+        return '{' in text or '\\' in text
+
+    def render(self, variable_format) -> str:
+        if self.segments is None:
+            return self.text
+        key = getattr(variable_format, '__func__', variable_format)
+        if self._rendered is None:
+            self._rendered = {}
+        rendered = self._rendered.get(key)
+        if rendered is None:
+            rendered = ''.join(variable_format(segment) if i % 2 else segment
+                               for i, segment in enumerate(self.segments))
+            # replace escaped curlies
+            rendered = rendered.replace(r'\{', '{').replace(r'\}', '}')
+            self._rendered[key] = rendered
+        return rendered
+
+    # a template from segments that already alternate literals and variables
+    @classmethod
+    def from_segments(cls, segments):
+        template = cls.__new__(cls)
+        template.text = None
+        template._rendered = None
+        template.segments = tuple(segments)
+        return template
+
+
+def render_value(value, variable_format) -> str:
+    if isinstance(value, str):
+        return value
+    return value.render(variable_format)
+
+
+def references(value) -> tuple:
+    if isinstance(value, str) or value.segments is None:
+        return ()
+    return value.segments[1::2]
+
+
+# the variables set in the config as one shell sees them, resolved once. a
+# variable is a constant when its value has no references left after inlining
+# the constants it references, those are inlined wherever they are referenced.
+# a variable referencing itself extends the value it inherits, so that
+# reference is left for the shell like the ones to variables the config never
+# sets
+class VariableFolding:
+    def __init__(self, values: dict):
+        self.values = values
+        # the escaped text of each constant, ready to be inlined
+        self.constants = {}
+        # every variable after the ones it references
+        self.order = []
+        self.cycles = []
+        self.undefined = set()
+        self._folded = {}
+        # 1 while visiting a variable's references and 2 once it is folded
+        state = {}
+        for name in values:
+            if name not in state:
+                self._visit(name, state, [])
+
+    def _visit(self, name, state, chain):
+        state[name] = 1
+        chain.append(name)
+        for reference in references(self.values[name]):
+            if reference == name:
+                continue
+            if reference not in self.values:
+                self.undefined.add(reference)
+            elif state.get(reference) == 1:
+                self.cycles.append(chain[chain.index(reference):] + [reference])
+            elif reference not in state:
+                self._visit(reference, state, chain)
+        chain.pop()
+        state[name] = 2
+        value = self.fold(self.values[name])
+        if not references(value):
+            self.constants[name] = value if isinstance(value, str) else value.segments[0]
+        self.order.append(name)
+
+    def fold(self, value):
+        if isinstance(value, str) or value.segments is None:
+            return value
+        folded = self._folded.get(value)
+        if folded is not None:
+            return folded
+        segments = value.segments
+        out = [segments[0]]
+        for i in range(1, len(segments), 2):
+            name, literal = segments[i], segments[i + 1]
+            constant = self.constants.get(name)
+            if constant is None:
+                out += [name, literal]
+            else:
+                out[-1] += constant + literal
+        if len(out) == 1 and not Template.needed(out[0]):
+            folded = out[0]
+        else:
+            folded = Template.from_segments(out)
+        self._folded[value] = folded
+        return folded
+
+    def errors(self) -> list:
+        return [ConfigError('variables reference each other in a cycle: ' + ' -> '.join(cycle))
+                for cycle in self.cycles]
+
+
+# one row per command, shared by every shell the command targets instead of
+# each shell keeping its own copy
+class Entry:
+    __slots__ = ('kind', 'key', 'value', 'shells')
+
+    def __init__(self, kind, key, value, shells):
+        self.kind = kind
+        self.key = key
+        self.value = value
+        self.shells = shells
+
+
+# the entries of every shell in a ShellSet, each shell has one bit and an entry
+# targets the shells whose bits are set in its mask. abbreviations are kept with
+# the aliases since most shells turn them into aliases
+class EntryTable:
+    KINDS = {'alias': 'alias', 'abbr': 'alias', 'env': 'env', 'path': 'path', 'typo': 'typo'}
+
+    def __init__(self):
+        self.rows = {'alias': [], 'env': [], 'path': [], 'typo': []}
+        # the shells with at least one entry of each kind and of any kind
+        self.kind_shells = dict.fromkeys(self.KINDS, 0)
+        self.shells = 0
+
+    def add(self, kind, key, value, shells):
+        if not shells:
+            return
+        # values are only parsed when they have variables or escapes to render
+        if isinstance(value, Template):
+            value = value if value.segments is not None else value.text
+        elif Template.needed(value):
+            value = Template(value)
+        if key is not None:
+            key = sys.intern(key)
+        self.rows[self.KINDS[kind]].append(Entry(kind, key, value, shells))
+        self.kind_shells[kind] |= shells
+        self.shells |= shells
+
+    def entries(self, kinds, bit):
+        if not kinds:
+            return ()
+        rows = self.rows[self.KINDS[kinds[0]]]
+        return (entry for entry in rows if entry.shells & bit and entry.kind in kinds)
+
+    def has(self, kinds, bit) -> bool:
+        return any(self.kind_shells[kind] & bit for kind in kinds)
+
+
+# the revisions of sections, unique across every shell and ShellSet
+SECTION_REVISIONS = count(1)
+
+
 class Shell:
+    # the methods that decide what each section renders to, shells with the same
+    # revision of a section and the same methods render it identically
+    SECTION_METHODS = {
+        'env_variables': ('entry_item', 'env_variable_format', 'env_variable_lines', 'ESCAPES'),
+        'paths_to_add': ('env_variable_format', 'add_path_lines', 'add_paths_to_string',
+                         'combined_paths_to_string', 'guarded_path_lines', 'ESCAPES'),
+        'aliases': ('entry_item', 'env_variable_format', 'alias_lines', 'alias_to_string',
+                    'batched_alias_lines', 'ESCAPES'),
+        'abbrs': ('entry_item', 'env_variable_format', 'abbr_lines', 'ESCAPES'),
+        'typos': ('env_variable_format', 'typo_lines', 'ESCAPES', 'COMMAND_NOT_FOUND'),
+    }
+    # the kinds of entries each section is read from
+    SECTION_KINDS = {
+        'env_variables': ('env',),
+        'paths_to_add': ('path',),
+        'aliases': ('alias', 'abbr'),
+        'abbrs': (),
+        'typos': ('typo',),
+    }
+    ESCAPES = POSIX_ESCAPES
+    # the settings that change how a section renders
+    SECTION_SETTINGS = {
+        'env_variables': ('variable_mode',),
+        'paths_to_add': ('path_mode', 'variable_mode'),
+        'aliases': ('alias_mode', 'variable_mode'),
+        'abbrs': ('variable_mode',),
+        'typos': ('variable_mode',),
+    }
+    # the function bash calls for commands it can't find and what it prints then
+    COMMAND_NOT_FOUND = ('command_not_found_handle', "'bash: %s: command not found\\n'")
+    # shells without a hook get every permutation of a typo table entry instead
+    RESOLVES_TYPOS = True
+    # bash and zsh run the hook in a subshell, so cd, export and the like
+    # change nothing there
+    TYPO_HOOK_SUBSHELL = True
+
     def __init__(self):
-        self.env_variables = {}
         self.config_path = "~/.easy_env_bash"
-        self.aliases = {}
-        self.abbrs = dict()
         self.motion_mode = MotionMode.NORMAL
-        self.paths_to_add = []
+        self.path_mode = PathMode.SEPARATE
+        self.alias_mode = AliasMode.SEPARATE
+        self.variable_mode = VariableMode.RUNTIME
+        self._folding = None
+        # see outputs
+        self.env_config_path = None
+        # replaced by ShellSet with the table shared by all of its shells
+        self.entries = EntryTable()
+        self.bit = 1
+        # set by ShellSet, see ShellSet._advance_revisions
+        self.revisions = dict.fromkeys(self.SECTION_METHODS, 0)
+        self.section_cache = None
 
     @property
     def shell_name(self):
@@ -101,39 +692,118 @@ class Shell:
 
     @property
     def updated(self) -> bool:
+        return bool(self.entries.shells & self.bit)
+
+    def has_section(self, section) -> bool:
+        kinds = self.SECTION_KINDS[section]
+        return bool(kinds) and self.entries.has(kinds, self.bit)
+
+    # the entries of a section as this shell sees them, later entries replace
+    # earlier ones with the same key
+    def section(self, section):
+        kinds = self.SECTION_KINDS[section]
+        variable_format = self.env_variable_format
+        entries = self.entries.entries(kinds, self.bit)
+        if self.variable_mode is VariableMode.FOLDED:
+            return self._folded_section(section, entries)
+        if section == 'paths_to_add':
+            return [render_value(entry.value, variable_format) for entry in entries]
+        items = {}
+        entry_item = self.entry_item
+        for entry in entries:
+            value = entry.value
+            if not isinstance(value, str):
+                value = value.render(variable_format)
+            key, value = entry_item(entry.kind, entry.key, value)
+            items[key] = value
+        return items
+
+    def _folded_section(self, section, entries):
+        folding = self.folding()
+        values = ((entry, render_value(folding.fold(entry.value), self.env_variable_format))
+                  for entry in entries)
+        if section == 'paths_to_add':
+            return [value for _, value in values]
+        items = {}
+        for entry, value in values:
+            key, value = self.entry_item(entry.kind, entry.key, value)
+            items[key] = value
+        if section == 'env_variables':
+            items = {key: items[key] for key in folding.order if key in items}
+        return items
+
+    # the variables this shell sets, folded again only when they change
+    def folding(self) -> VariableFolding:
+        key = (self.revisions['env_variables'], len(self.entries.rows['env']))
+        if self._folding is None or self._folding[0] != key:
+            values = {entry.key: entry.value
+                      for entry in self.entries.entries(('env',), self.bit)}
+            self._folding = (key, VariableFolding(values))
+        return self._folding[1]
+
+    def entry_item(self, kind, key, value):
+        return key, value
 
-        fields_to_check = [self.aliases, self.abbrs,
-                           self.env_variables, self.paths_to_add]
-
-        return any(not empty(attr) for attr in fields_to_check)
+    @property
+    def env_variables(self):
+        return self.section('env_variables')
 
-    def reformat_env_variables(self, line: str):
-        pattern = r'(?<!\\){([^}]*)}'
+    @property
+    def paths_to_add(self):
+        return self.section('paths_to_add')
 
-        # Use re.sub with a function to substitute the matched content
-        result = re.sub(
-            pattern, lambda match: self._env_variable_format(match), line)
+    @property
+    def aliases(self):
+        return self.section('aliases')
 
-        # replace escaped curlies
-        result = result.replace(r'\{', '{').replace(r'\}', '}')
-        return result
+    @property
+    def abbrs(self):
+        return self.section('abbrs')
 
-    def _env_variable_format(self, match):
-        return self.env_variable_format(match.group(1))
+    @property
+    def typos(self):
+        return self.section('typos')
+
+    # the typos of every key by its sorted characters, which every permutation
+    # of the key shares. keys that are permutations of each other share an
+    # entry, none of them is a typo and the last one's value resolves the rest
+    def typo_table(self):
+        table = {}
+        for key, value in self.typos.items():
+            sorted_key = ''.join(sorted(key))
+            keys = table[sorted_key][0] if sorted_key in table else []
+            keys.append(key)
+            table[sorted_key] = keys, value
+        return table
+
+    def reformat_env_variables(self, value):
+        if not isinstance(value, Template):
+            value = Template(value)
+        return value.render(self.env_variable_format)
 
     def env_variable_format(self, variable):
         return f'${variable}'
 
+    # a shell changed on its own no longer renders a section like any other shell
+    def _advance_revisions(self, *sections):
+        for section in sections:
+            self.revisions[section] = next(SECTION_REVISIONS)
+
+    # whether the hook can run value for a typo, the others get every permutation
+    def resolves_typo(self, value) -> bool:
+        return self.RESOLVES_TYPOS and not (self.TYPO_HOOK_SUBSHELL and changes_shell_state(value))
+
     def add_abbr(self, key, val):
-        self.add_alias(key, val)
+        self._advance_revisions('aliases', 'abbrs')
+        self.entries.add('abbr', key, val, self.bit)
 
     def add_path(self, path: str):
-        path = self.reformat_env_variables(path)
-        self.paths_to_add.append(path)
+        self._advance_revisions('paths_to_add')
+        self.entries.add('path', None, path, self.bit)
 
     def add_alias(self, key, val):
-        val = self.reformat_env_variables(val)
-        self.aliases[key] = val
+        self._advance_revisions('aliases')
+        self.entries.add('alias', key, val, self.bit)
 
     @property
     def emacs_motion_str(self):
@@ -156,85 +826,207 @@ class Shell:
         return False
 
     def set_environment_variable(self, key, val):
-        val = self.reformat_env_variables(val)
-        self.env_variables[key] = val
+        self._advance_revisions('env_variables')
+        self.entries.add('env', key, val, self.bit)
 
     def aliases_string(self) -> str:
-        out = ""
+        return '\n'.join(self.alias_lines())
+
+    def alias_lines(self):
+        if self.alias_mode is AliasMode.BATCHED:
+            yield from self.batched_alias_lines(self.aliases)
+            return
         for key, val in self.aliases.items():
-            out += f'{self.alias_to_string(key, val)}\n'
-        return out.removesuffix('\n')
+            yield self.alias_to_string(key, val)
 
-    def alias_to_string(self, key, value):
-        if self.alias_needs_quotes(value):
-            value = f'"{value}"'
-        return f'alias {key}={value}'
+    # alias takes any number of name=value pairs
+    def batched_alias_lines(self, aliases):
+        quoted = partial(self.ESCAPES.quoted, "'")
+        pairs = [f'{key}={value if is_quoted(value) else quoted(value)}' for key, value in aliases.items()]
+        for start in range(0, len(pairs), ALIAS_BATCH_SIZE):
+            yield 'alias ' + ' '.join(pairs[start:start + ALIAS_BATCH_SIZE])
 
-    def alias_needs_quotes(self, val: str):
-        has_problematic_char = any(c in val for c in ['|', '>', '&'])
-        return has_problematic_char and "'" not in val
+    def alias_to_string(self, key, value):
+        return f'alias {key}={self.ESCAPES.quote("alias", value)}'
 
     def add_paths_string(self):
-        out = ""
-        for path in self.paths_to_add:
-            out += f'{self.add_paths_to_string(path)}\n'
-        return out.removesuffix("\n")
+        return '\n'.join(self.add_path_lines())
+
+    def add_path_lines(self):
+        paths = self.paths_to_add
+        if self.path_mode is PathMode.SEPARATE:
+            for path in paths:
+                yield self.add_paths_to_string(path)
+            return
+        # the first occurrence wins, like it does when looking up a command
+        paths = list(dict.fromkeys(paths))
+        if self.path_mode is PathMode.GUARDED:
+            yield from self.guarded_path_lines(paths)
+        else:
+            yield self.combined_paths_to_string(paths)
 
     def add_paths_to_string(self, path):
-        return f'export PATH="$PATH:{path}"'
+        return 'export PATH="$PATH:' + self.ESCAPES.escape('"', path) + '"'
 
-    def abbrs_string(self) -> str:
-        out = ''
-        for key, val in self.abbrs.items():
+    def combined_paths_to_string(self, paths):
+        paths = ':'.join(self.ESCAPES.escape('"', path) for path in paths)
+        return f'export PATH="$PATH:{paths}"'
 
-            if self.alias_needs_quotes(key):
-                key = f"'{key}'"
+    # case is a builtin, so the check doesn't start a process per path
+    def guarded_path_lines(self, paths):
+        for path in paths:
+            path = self.ESCAPES.escape('"', path)
+            yield f'case ":$PATH:" in *":{path}:"*) ;; *) PATH="$PATH:{path}" ;; esac'
+        yield 'export PATH'
 
-            if self.alias_needs_quotes(val):
-                val = f"'{val}'"
-
-            out += f"abbr {key} {val}\n"
+    def abbrs_string(self) -> str:
+        return '\n'.join(self.abbr_lines())
 
-        out = out.removesuffix('\n')
-        return out
+    def abbr_lines(self):
+        quote = partial(self.ESCAPES.quote, 'abbr')
+        for key, val in self.abbrs.items():
+            yield f"abbr {quote(key)} {quote(val)}"
 
     def env_variable_string(self):
-        out = ""
+        return '\n'.join(self.env_variable_lines())
+
+    # looks up the sorted characters of a command that wasn't found, so the
+    # file defines one case per key instead of an alias per permutation. a
+    # handler defined before is kept under another name and handles the rest
+    def typo_lines(self):
+        quoted = partial(self.ESCAPES.quoted, "'")
+        function, message = self.COMMAND_NOT_FOUND
+        previous = f'_easy_env_previous_{function}'
+        # sourcing the file again must not save this handler as the previous one
+        yield f'if ! typeset -f {previous} >/dev/null && typeset -f {function} >/dev/null; then'
+        yield f'    eval "_easy_env_previous_$(typeset -f {function})"'
+        yield 'fi'
+        yield f'{function}() {{'
+        yield '    local sorted'
+        yield "    sorted=$(printf '%s' \"$1\" | fold -w1 | LC_ALL=C sort | tr -d '\\n')"
+        yield '    case "$sorted" in'
+        for sorted_key, (keys, value) in self.typo_table().items():
+            command = quoted(f'{value} "$@"')
+            typo = ' && '.join(f'[ "$1" != {quoted(key)} ]' for key in keys)
+            yield f'        {quoted(sorted_key)}) {typo} && {{ shift; eval {command}; return; }} ;;'
+        yield '    esac'
+        yield f'    if typeset -f {previous} >/dev/null; then'
+        yield f'        {previous} "$@"'
+        yield '        return'
+        yield '    fi'
+        yield f'    printf {message} "$1" >&2'
+        yield '    return 127'
+        yield '}'
+
+    def env_variable_lines(self):
+        quote = partial(self.ESCAPES.quote, 'env')
         for key, val in self.env_variables.items():
-            if len(val.split(' ')) > 1:
-                val = f'"{val}"'
-            out += f'export {key}={val}\n'
-
-        return out.removesuffix('\n')
+            yield f'export {key}={quote(val)}'
 
     def comment_string(self, input):
         return f'#{input}'
 
     def __str__(self):
-        out = ""
+        buffer = io.StringIO()
+        self.render(buffer)
+        return buffer.getvalue()
+
+    # writes the config section by section into a text or binary sink, such as
+    # an open file, sys.stdout or a BytesIO, without building it in memory first
+    def render(self, sink):
+        sink = text_sink(sink)
+        self._write_motion_mode(sink)
+        self._write_environment(sink)
+        self._write_interactive(sink)
+
+    # (path, render) for every file the shell writes, with an env_config_path
+    # env variables and PATH are written there for every shell to source and the
+    # config only gets what interactive shells use
+    def outputs(self):
+        if self.env_config_path is None:
+            return [(self.config_path, self.render)]
+        return [(self.env_config_path, self.render_environment),
+                (self.config_path, self.render_interactive)]
+
+    def render_environment(self, sink):
+        self._write_environment(text_sink(sink))
+
+    def render_interactive(self, sink):
+        sink = text_sink(sink)
+        start, end = self.interactive_guard
+        sink.write(start)
+        self._write_motion_mode(sink)
+        self._write_interactive(sink)
+        sink.write(end)
+
+    # written around the interactive part so sourcing it from a script,
+    # ssh host command or cron job doesn't define any aliases
+    @property
+    def interactive_guard(self):
+        return '[[ $- == *i* ]] || return 0\n\n', ''
+
+    def _write_motion_mode(self, sink):
         motion_mode = self.motion_mode_str
         if len(motion_mode) > 0:
-            out += motion_mode
-            out += '\n\n'
-        if len(self.env_variables) > 0:
-            out += self.comment_string("environment variables\n")
-            out += self.env_variable_string()
-            out += '\n\n'
-        if len(self.paths_to_add) > 0:
-            out += self.comment_string("update path\n")
-            out += self.add_paths_string()
-            out += '\n\n'
-        if len(self.aliases) > 0:
-            out += self.comment_string("aliases\n")
-            out += self.aliases_string()
-            out += '\n\n'
-        if len(self.abbrs) > 0:
-            out += self.comment_string("abbreviations\n")
-            out += self.abbrs_string()
-        return out
+            sink.write(f'{motion_mode}\n\n')
+
+    def _write_environment(self, sink):
+        if self.has_section('env_variables'):
+            sink.write(self.comment_string("environment variables\n"))
+            self._write_section(sink, 'env_variables', self.env_variable_lines)
+            sink.write('\n\n')
+        if self.has_section('paths_to_add'):
+            sink.write(self.comment_string("update path\n"))
+            self._write_section(sink, 'paths_to_add', self.add_path_lines)
+            sink.write('\n\n')
+
+    def _write_interactive(self, sink):
+        if self.has_section('aliases'):
+            sink.write(self.comment_string("aliases\n"))
+            self._write_section(sink, 'aliases', self.alias_lines)
+            sink.write('\n\n')
+        if self.has_section('typos'):
+            sink.write(self.comment_string("typo corrections\n"))
+            self._write_section(sink, 'typos', self.typo_lines)
+            sink.write('\n\n')
+        if self.has_section('abbrs'):
+            sink.write(self.comment_string("abbreviations\n"))
+            self._write_section(sink, 'abbrs', self.abbr_lines)
+
+    def section_key(self, section):
+        methods = tuple(getattr(type(self), name)
+                        for name in self.SECTION_METHODS[section])
+        settings = tuple(getattr(self, name) for name in self.SECTION_SETTINGS[section])
+        # the revision only advances once per targeting, the number of rows
+        # tells apart the entries added to it since the section was rendered
+        revision = self._revision(section)
+        # folded sections also depend on the variables they inline
+        if self.variable_mode is VariableMode.FOLDED:
+            revision = (revision, self._revision('env_variables'))
+        return (section, revision, self.SECTION_KINDS[section], methods, settings)
+
+    def _revision(self, section):
+        kinds = self.SECTION_KINDS[section]
+        rows = len(self.entries.rows[EntryTable.KINDS[kinds[0]]]) if kinds else 0
+        return self.revisions[section], rows
+
+    # sections shared with another shell are rendered once and kept by the
+    # ShellSet, everything else is streamed straight into the sink
+    def _write_section(self, sink, section, lines):
+        cache = self.section_cache
+        key = self.section_key(section) if cache else None
+        if key is None or key not in cache:
+            _write_lines(sink, lines())
+            return
+        rendered = cache[key]
+        if rendered is None:
+            rendered = cache[key] = '\n'.join(lines())
+        sink.write(rendered)
 
 
 class Zsh(Shell):
+    COMMAND_NOT_FOUND = ('command_not_found_handler', "'zsh: command not found: %s\\n'")
+
     def __init__(self):
         super().__init__()
         self.config_path = "~/.easy_env_zsh"
@@ -251,26 +1043,42 @@ class Zsh(Shell):
     def shell_name(self):
         return "zsh"
 
+    @property
+    def interactive_guard(self):
+        return '[[ -o interactive ]] || return 0\n\n', ''
+
     def add_paths_to_string(self, path):
-        if ' ' in path:
-            path = f'"{path}"'
-        return f'path+={path}'
+        return f'path+={self.ESCAPES.quote("path", path)}'
+
+    def combined_paths_to_string(self, paths):
+        paths = ' '.join(self.ESCAPES.quote('path', path) for path in paths)
+        return f'path+=({paths})'
+
+    # typeset -U keeps only the first occurrence of every directory in path
+    def guarded_path_lines(self, paths):
+        yield 'typeset -U path PATH'
+        yield self.combined_paths_to_string(paths)
 
 
 class Nu(Shell):
+    RESOLVES_TYPOS = False
+    ESCAPES = NU_ESCAPES
 
+    # pipelines can't be aliased so they become commands
     def alias_to_string(self, key, value):
-        problematic_chars = ['|', "&", '>', '<']
-
-        for problem_char in problematic_chars:
-            if problem_char in value:
-                out = f'def {key} [...args] '
-                out += '{'
-                out += value
-                out += ' ...$args}'
-                return out
+        if classify(value) & PIPELINE:
+            out = f'def {key} [...args] '
+            out += '{'
+            out += value
+            out += ' ...$args}'
+            return out
         return f'alias {key} = {value}'
 
+    # nu has no way to define several aliases at once
+    def batched_alias_lines(self, aliases):
+        for key, value in aliases.items():
+            yield self.alias_to_string(key, value)
+
     @property
     def emacs_motion_str(self):
         return '$env.config.edit_mode = "emacs"'
@@ -290,24 +1098,44 @@ class Nu(Shell):
     def shell_name(self):
         return "nu"
 
-    def env_variable_string(self):
-        out = ""
+    # nu only reads its config in interactive sessions
+    @property
+    def interactive_guard(self):
+        return '', ''
+
+    def env_variable_lines(self):
+        quote = partial(self.ESCAPES.quote, 'env')
         for key, val in self.env_variables.items():
-            line = f'$env.{key} = '
-            if not val.startswith('"') and not val.startswith("'"):
-                line += '"'
-            line += val
-            if not val.endswith('"') and not val.endswith("'"):
-                line += '"'
-            out += f'{line}\n'
-        return out.removesuffix('\n')
+            yield f'$env.{key} = {quote(val)}'
 
     def add_paths_to_string(self, path):
         return f'$env.path ++= [{path}]'
 
+    def combined_paths_to_string(self, paths):
+        return f'$env.path ++= [{", ".join(paths)}]'
+
+    def guarded_path_lines(self, paths):
+        yield f'$env.path = ($env.path ++ [{", ".join(paths)}] | uniq)'
+
 
 # TODO for fish writing a alias i can use an equals sign or not but either way if the values have more then one string then I need to use an quotes
+# what builtin --names lists, fish's alias calls these with builtin
+FISH_BUILTINS = frozenset((
+    '.', ':', '[', '_', 'abbr', 'and', 'argparse', 'begin', 'bg', 'bind', 'block', 'break',
+    'breakpoint', 'builtin', 'case', 'cd', 'command', 'commandline', 'complete', 'contains',
+    'continue', 'count', 'disown', 'echo', 'else', 'emit', 'end', 'eval', 'exec', 'exit', 'false',
+    'fg', 'for', 'function', 'functions', 'history', 'if', 'jobs', 'math', 'not', 'or', 'path',
+    'printf', 'pwd', 'random', 'read', 'realpath', 'return', 'set', 'set_color', 'source',
+    'status', 'string', 'switch', 'test', 'time', 'true', 'type', 'ulimit', 'wait', 'while'))
+
+
 class Fish(Shell):
+    ESCAPES = FISH_ESCAPES
+    # fish_command_not_found runs in the shell itself
+    TYPO_HOOK_SUBSHELL = False
+    SECTION_KINDS = {**Shell.SECTION_KINDS,
+                     'aliases': ('alias',), 'abbrs': ('abbr',)}
+
     def __init__(self):
         super().__init__()
         self.config_path = "~/.config/fish/easy_env.fish"
@@ -316,6 +1144,10 @@ class Fish(Shell):
     def shell_name(self):
         return "fish"
 
+    @property
+    def interactive_guard(self):
+        return 'if status is-interactive\n', '\nend\n'
+
     @property
     def emacs_motion_str(self):
         return "fish_default_key_bindings"
@@ -324,45 +1156,88 @@ class Fish(Shell):
     def vi_motion_str(self):
         return "fish_vi_key_bindings"
 
-    def add_abbr(self, key, val):
-        val = self.reformat_env_variables(val)
-        self.abbrs[key.strip()] = val.strip()
+    def entry_item(self, kind, key, value):
+        if kind == 'abbr':
+            return key.strip(), value.strip()
+        return key, value
+
+    def typo_lines(self):
+        quoted = partial(self.ESCAPES.quoted, "'")
+        previous = '_easy_env_previous_fish_command_not_found'
+        yield f'if not functions -q {previous}; and functions -q fish_command_not_found'
+        yield f'    functions -c fish_command_not_found {previous}'
+        yield 'end'
+        yield 'function fish_command_not_found'
+        yield "    set -l sorted (string split '' -- $argv[1] | LC_ALL=C sort | string join '')"
+        yield '    switch $sorted'
+        for sorted_key, (keys, value) in self.typo_table().items():
+            yield f'        case {quoted(sorted_key)}'
+            yield f'            if not contains -- $argv[1] {" ".join(quoted(key) for key in keys)}'
+            yield f'                eval {quoted(value)} (string escape -- $argv[2..])'
+            yield '                return'
+            yield '            end'
+        yield '    end'
+        yield f'    if functions -q {previous}'
+        yield f'        {previous} $argv'
+        yield '    else'
+        yield '        __fish_default_command_not_found_handler $argv'
+        yield '    end'
+        yield 'end'
 
     def add_paths_to_string(self, path):
-        if ' ' in path:
-            path = f'"{path}"'
-        return f'fish_add_path {path}'
+        return f'fish_add_path {self.ESCAPES.quote("path", path)}'
+
+    def combined_paths_to_string(self, paths):
+        paths = ' '.join(self.ESCAPES.quote('path', path) for path in paths)
+        return f'fish_add_path {paths}'
+
+    # fish_add_path already skips directories that are in PATH
+    def guarded_path_lines(self, paths):
+        yield self.combined_paths_to_string(paths)
 
     def supports_abbreviations(self):
         return True
 
     def alias_to_string(self, key, val):
-        val = self.reformat_env_variables(val)
-        if self.alias_needs_quotes(val):
-            val = f'"{val}"'
-        return f'alias {key} {val}'
+        return f'alias {key} {self.ESCAPES.quote("alias", val)}'
+
+    # alias is a function that builds and evaluates a function definition for
+    # every alias, defining the function directly skips that work. like alias,
+    # the quotes around a value are dropped from the body and a function running
+    # a command of its own name calls the builtin or command instead of itself
+    def batched_alias_lines(self, aliases):
+        quoted = partial(self.ESCAPES.quoted, "'")
+        for key, value in aliases.items():
+            if is_quoted(value):
+                value = value[1:-1]
+            if value.split(maxsplit=1)[:1] == [key]:
+                prefix = 'builtin' if key in FISH_BUILTINS else 'command'
+                yield f'function {key}; {prefix} {value} $argv; end'
+            else:
+                yield f'function {key} --wraps {quoted(value)}; {value} $argv; end'
 
-    def env_variable_string(self):
-        out = ""
+    def env_variable_lines(self):
+        quote = partial(self.ESCAPES.quote, 'env')
         for key, val in self.env_variables.items():
-            out += f'set -gx {key} {val}\n'
-        return out.removesuffix('\n')
+            yield f'set -gx {key} {quote(val)}'
 
 
 class Murex(Shell):
+    RESOLVES_TYPOS = False
 
     def alias_to_string(self, key, value):
-        problematic_chars = ['|', "&", '>', '<']
-
-        for problem_char in problematic_chars:
-            if problem_char in value:
-                out = f'function {key} ()'
-                out += '{\n'
-                out += value
-                out += ' $ARGS\n}'
-                return out
+        if classify(value) & PIPELINE:
+            out = f'function {key} ()'
+            out += '{\n'
+            out += value
+            out += ' $ARGS\n}'
+            return out
         return f'alias {key} = {value}'
 
+    def batched_alias_lines(self, aliases):
+        for key, value in aliases.items():
+            yield self.alias_to_string(key, value)
+
     def __init__(self):
         super().__init__()
         self.config_path = "~/.config/murex/murex_easy_env"
@@ -371,142 +1246,594 @@ class Murex(Shell):
     def shell_name(self):
         return "murex"
 
+    @property
+    def interactive_guard(self):
+        return '', ''
+
     def add_paths_to_string(self, path):
         return f'$PATH -> append {path} -> export PATH'
 
+    def combined_paths_to_string(self, paths):
+        return f'$PATH -> append {" ".join(paths)} -> export PATH'
+
+    def guarded_path_lines(self, paths):
+        yield self.combined_paths_to_string(paths)
+
 
 class Xonsh(Shell):
+    RESOLVES_TYPOS = False
 
     def alias_to_string(self, key, value):
-        problematic_chars = ['|', "&", '>', '<']
-
-        for problem_char in problematic_chars:
-            if problem_char in value:
-                out = f'def {key} ()'
-                out += '{\n'
-                out += value
-                out += ' $ARGS\n}'
-                return out
+        if classify(value) & PIPELINE:
+            out = f'def {key} ()'
+            out += '{\n'
+            out += value
+            out += ' $ARGS\n}'
+            return out
         return f'alias {key} = {value}'
 
+    def batched_alias_lines(self, aliases):
+        for key, value in aliases.items():
+            yield self.alias_to_string(key, value)
+
     def __init__(self):
         super().__init__()
         self.config_path = "~/.config/xonsh/easy_env.xsh"
 
     @property
     def shell_name(self):
-        return "murex"
+        return "xonsh"
+
+    @property
+    def interactive_guard(self):
+        return '', ''
 
     def add_paths_to_string(self, path):
         return f'$PATH -> append {path} -> export PATH'
 
+    def combined_paths_to_string(self, paths):
+        return f'$PATH -> append {" ".join(paths)} -> export PATH'
+
+    def guarded_path_lines(self, paths):
+        yield self.combined_paths_to_string(paths)
+
+
+# every shell that can be written by the name the config uses for it, in the
+# order they are written. plugins add theirs with register_shell
+SHELLS = {"nu": Nu, "fish": Fish, "bash": Shell, "zsh": Zsh, "murex": Murex, "xonsh": Xonsh}
+
 
 class ShellSet:
-    def __init__(self, current_shells={"nu", "bash", "fish", "zsh", "murex", "xonsh"}):
-        self.all_shells = {"nu": Nu(), "fish": Fish(),
-                           "bash": Shell(), "zsh": Zsh(),
-                           "murex": Murex(), "xonsh": Xonsh()}
+    # targets every shell when current_shells is None. a shell is only created
+    # once a command targets it or gives it a path, all_shells holds those
+    def __init__(self, current_shells=None):
+        self.all_shells = {}
+        if current_shells is None:
+            current_shells = list(SHELLS)
+        self.entries = EntryTable()
+        self.section_cache = {}
+        self._revisions = {}
+        self._epoch = 0
+        self._advanced = set()
         self.current_shells = self._get_shells(current_shells)
         self.set_targets(current_shells)
 
-    def __iter__(self):
-        return (val for val in self.all_shells.values() if val.updated)
+    def shell(self, name):
+        shell = self.all_shells.get(name)
+        if shell is None:
+            shell = SHELLS[name]()
+            shell.entries = self.entries
+            shell.bit = 1 << len(self.all_shells)
+            shell.section_cache = self.section_cache
+            self.all_shells[name] = shell
+        return shell
 
+    def __iter__(self):
+        updated = self._updated_shells()
+        self._share_sections(updated)
+        return iter(updated)
+
+    # in the order of SHELLS, whichever order they were created in
+    def _updated_shells(self):
+        return [self.all_shells[name] for name in SHELLS
+                if name in self.all_shells and self.all_shells[name].updated]
+
+    # marks the sections more than one shell would render identically so they
+    # are rendered once, bash and zsh usually share all of them
+    def _share_sections(self, shells):
+        counts = Counter(shell.section_key(section) for shell in shells
+                         for section in Shell.SECTION_METHODS if shell.has_section(section))
+        shared = {key for key, count in counts.items() if count > 1}
+        for key in list(self.section_cache):
+            if key not in shared:
+                del self.section_cache[key]
+        for key in shared:
+            self.section_cache.setdefault(key, None)
+
+    # every shell in the current targets receives the same commands until the
+    # targets change again, so shells that had the same revision of a section at
+    # the start of a targeting end up with the same revision of it afterwards
+    def _advance_revisions(self, *sections):
+        for section in sections:
+            if section in self._advanced:
+                continue
+            self._advanced.add(section)
+            for shell in self.current_shells:
+                key = (section, shell.revisions[section], self._epoch)
+                revision = self._revisions.get(key)
+                if revision is None:
+                    revision = self._revisions[key] = next(SECTION_REVISIONS)
+                shell.revisions[section] = revision
+
+    # each command is one row of the shared entry table targeting the bits of
+    # the current shells
     def add_alias(self, key, value):
-        for shell in self.current_shells:
-            shell.add_alias(key, value)
+        self._advance_revisions('aliases')
+        self.entries.add('alias', key, value, self._targets)
 
     def add_abbr(self, key, value):
-        for shell in self.current_shells:
-            shell.add_abbr(key, value)
+        self._advance_revisions('aliases', 'abbrs')
+        self.entries.add('abbr', key, value, self._targets)
 
     def set_env_variable(self, key, value):
-        for shell in self.current_shells:
-            shell.set_environment_variable(key, value)
+        self._advance_revisions('env_variables')
+        self.entries.add('env', key, value, self._targets)
 
     def add_path(self, path):
-        for shell in self.current_shells:
-            shell.add_path(path)
+        self._advance_revisions('paths_to_add')
+        self.entries.add('path', None, path, self._targets)
+
+    # a key the engine wrote to a typo table instead of expanding its
+    # permutations, shells with a command not found hook look its typos up when
+    # they happen and the others get every permutation like before
+    def add_typos(self, kind, key, value, directive):
+        if directive not in PERMUTATION_DIRECTIVES:
+            raise ValueError(f'unknown directive: {directive}')
+        add = {'alias': self.add_alias, 'abbr': self.add_abbr}[kind]
+        if directive == 'permutate key':
+            add(key, value)
+        shells = self.current_shells
+        try:
+            self.set_targets([name for name, shell in self.all_shells.items()
+                              if shell in shells and shell.resolves_typo(value)])
+            self._advance_revisions('typos')
+            self.entries.add('typo', key, value, self._targets)
+            self.set_targets([name for name, shell in self.all_shells.items()
+                              if shell in shells and not shell.resolves_typo(value)])
+            if self.current_shells:
+                for permutation in PermutationEngine._lexicographic_permutations(sorted(key)):
+                    if permutation != key:
+                        add(permutation, value)
+        finally:
+            self.set_targets([name for name, shell in self.all_shells.items() if shell in shells])
 
     def set_targets(self, shells):
+        self._epoch += 1
+        self._advanced = set()
         self.current_shells = self._get_shells(shells)
+        self._targets = 0
+        for shell in self.current_shells:
+            self._targets |= shell.bit
 
     def set_compile_path(self, shell, path):
-        self.all_shells[shell].config_path = path
+        self.shell(shell).config_path = path
+
+    def set_compile_env_path(self, shell, path):
+        self.shell(shell).env_config_path = path
 
     def set_motion_mode(self, mode):
         for shell in self.current_shells:
             shell.motion_mode = MotionMode(mode)
 
+    def set_path_mode(self, mode):
+        mode = PathMode(mode)
+        for shell in self.current_shells:
+            shell.path_mode = mode
+
+    def set_alias_mode(self, mode):
+        mode = AliasMode(mode)
+        for shell in self.current_shells:
+            shell.alias_mode = mode
+
+    def set_variable_mode(self, mode):
+        mode = VariableMode(mode)
+        for shell in self.current_shells:
+            shell.variable_mode = mode
+
+    def _folded_shells(self):
+        return [shell for shell in self._updated_shells()
+                if shell.variable_mode is VariableMode.FOLDED]
+
+    # cycles between the variables of the shells that fold them, each reported once
+    def variable_errors(self) -> list:
+        errors = {}
+        for shell in self._folded_shells():
+            for error in shell.folding().errors():
+                errors.setdefault(error.message, error)
+        return list(errors.values())
+
+    def variable_report(self) -> str:
+        out = []
+        for shell in self._folded_shells():
+            folding = shell.folding()
+            line = (f'{shell.shell_name}: folded {len(folding.constants)} of '
+                    f'{len(folding.values)} variable(s)')
+            if folding.undefined:
+                line += f', left to the shell: {", ".join(sorted(folding.undefined))}'
+            out.append(line)
+        return '\n'.join(out)
+
     def _get_shells(self, shells_as_strings):
         out: set = set()
         for shell in shells_as_strings:
-            out.add(self.all_shells[shell])
+            out.add(self.shell(shell))
         return out
 
 
-def _get_params(command: str) -> tuple:
-    start = command.find('(')
-    end = command.rfind(')')
+class ConfigError(Exception):
+    def __init__(self, message, path=None, line_number=None):
+        super().__init__(message)
+        self.message = message
+        self.path = path
+        self.line_number = line_number
 
-    # Ensure both parentheses are found and properly ordered
-    if start == -1 or end == -1 or start > end:
-        return tuple()
+    def __str__(self):
+        if self.path is None:
+            return self.message
+        return f'{self.path}:{self.line_number}: {self.message}'
 
-    # Get the substring inside the parentheses
-    params_str = command[start + 1:end].strip()
 
-    # Return tuple of parameters, empty string check avoids ['']
-    if not params_str:
-        return tuple()
+class Command:
+    __slots__ = ('name', 'params', 'directives', 'path', 'line_number')
 
-    # Split by commas and strip whitespace
-    params = tuple(param.strip() for param in params_str.split(','))
-    return params
+    def __init__(self, name, params, directives=(), path=None, line_number=None):
+        self.name = name
+        # None when the line has no parameter list at all
+        self.params = params
+        self.directives = directives
+        self.path = path
+        self.line_number = line_number
+
+    def __str__(self):
+        if self.params is None:
+            return self.name
+        return f'{self.name}({", ".join(self.params)})'
+
+    def __repr__(self):
+        return f'Command({str(self)!r}, {self.path}:{self.line_number})'
+
+    def error(self, message) -> ConfigError:
+        return ConfigError(message, self.path, self.line_number)
+
+    def to_json(self) -> str:
+        return json.dumps([self.line_number, self.name, self.params])
+
+    @classmethod
+    def from_json(cls, line, path):
+        line_number, name, params = json.loads(line)
+        return cls(name, params if params is None else tuple(params), (), path, line_number)
+
+
+_COMMENT_PATTERN = re.compile(r'(?<!\\)#')
+_COMMAND_PATTERN = re.compile(r'\s*([^(]*?)\s*\((.*)\)\s*(?:->(.*))?$')
+
+
+# a single pass over each line, comments and \# escapes are only looked at when
+# the line contains a # and everything else is one precompiled match
+def tokenize_line(line: str, path=None, line_number=None):
+    if '#' in line:
+        match = _COMMENT_PATTERN.search(line)
+        if match:
+            line = line[:match.start()]
+        line = line.replace('\\#', '#')
+    line = line.strip()
+    if not line:
+        return None
+
+    match = _COMMAND_PATTERN.match(line)
+    if match is None:
+        return Command(line, None, (), path, line_number)
+    name, params, directives = match.groups()
+    params = params.strip()
+    params = tuple(param.strip() for param in params.split(',')) if params else ()
+    if directives is None:
+        directives = ()
+    else:
+        directives = tuple(directive.strip()
+                           for directive in directives.split(','))
+    return Command(name, params, directives, path, line_number)
+
+
+def parse_lines(lines, path=None):
+    for line_number, line in enumerate(lines, 1):
+        command = tokenize_line(line, path, line_number)
+        if command is not None:
+            yield command
+
+
+class PermutationLimitError(ValueError):
+    pass
+
+
+PERMUTATION_DIRECTIVES = ('permutate key', 'other key permutations')
+
+
+# generates the distinct permutations of a key directly in lexicographic order
+# instead of generating all n! tuples and deduplicating them through a set.
+# with typo_table set aliases and abbreviations aren't expanded here, they
+# become one TYPO_TABLE_COMMAND each, see ShellSet.add_typos
+class PermutationEngine:
+    def __init__(self, max_key_length=12, max_permutations=100_000, typo_table=False):
+        self.max_key_length = max_key_length
+        self.max_permutations = max_permutations
+        self.typo_table = typo_table
+
+    # everything that changes what preprocessing produces, for the build cache
+    def key(self) -> str:
+        return f'{self.max_key_length}:{self.max_permutations}:{int(self.typo_table)}'
+
+    @staticmethod
+    def count(key: str) -> int:
+        total = factorial(len(key))
+        for repeats in Counter(key).values():
+            total //= factorial(repeats)
+        return total
+
+    # the length is checked first, counting the permutations of a long key is
+    # slow and the count can be too large to print
+    def check(self, key: str):
+        if len(key) > self.max_key_length:
+            raise PermutationLimitError(
+                f"cannot permutate '{key}', it is {len(key)} characters long which is over the limit of "
+                f"{self.max_key_length}")
+        count = self.count(key)
+        if count > self.max_permutations:
+            raise PermutationLimitError(
+                f"cannot permutate '{key}', it would generate {count:,} permutations which is over the limit of "
+                f"{self.max_permutations:,}")
+
+    def permutations(self, key: str):
+        self.check(key)
+        return self._lexicographic_permutations(sorted(key))
+
+    @staticmethod
+    def _lexicographic_permutations(chars: list):
+        last = len(chars) - 1
+        while True:
+            yield ''.join(chars)
+            i = last - 1
+            while i >= 0 and chars[i] >= chars[i + 1]:
+                i -= 1
+            if i < 0:
+                return
+            j = last
+            while chars[j] <= chars[i]:
+                j -= 1
+            chars[i], chars[j] = chars[j], chars[i]
+            chars[i + 1:] = reversed(chars[i + 1:])
+
+
+DEFAULT_PERMUTATION_ENGINE = PermutationEngine()
+
+
+class IncludeCycleError(Exception):
+    def __init__(self, chain):
+        super().__init__(f'source cycle: {" -> ".join(chain)}')
+        self.chain = chain
+
+
+# the files sourced during one run. a file sourced more than once is
+# preprocessed once and kept only until its last reference, every other file
+# is streamed. a file that sources itself, directly or through other files, is
+# reported instead of recursing forever
+class IncludeGraph:
+    def __init__(self, root=None, prefetched=None, read=None, resolve=os.path.realpath, references=None):
+        # turns paths into the keys files are told apart by
+        self.resolve = resolve
+        # the real paths of the files being sourced, outermost first
+        self.chain = [] if root is None else [resolve(root)]
+        self._base = len(self.chain)
+        # real path -> (mtime, content) from prefetch_includes
+        self.prefetched = prefetched or {}
+        # returns the content of files that weren't prefetched, None streams them from disk
+        self.read = read
+        # real path -> how often it is still sourced, from prefetch_includes. when
+        # unknown a file is kept from its second reference to the end of the run
+        self.remaining = None if references is None else dict(references)
+        # (real path, mtime) -> preprocessed commands
+        self.commands = {}
+        # every path a source(...) named, missing files included
+        self.paths = set()
+        self.sourced = set()
+        self.references = 0
+        self.reused = 0
+        self.skipped = 0
+        self.max_depth = 0
+
+    def enter(self, real_path):
+        if real_path in self.chain:
+            raise IncludeCycleError(
+                self.chain[self.chain.index(real_path):] + [real_path])
+        self.chain.append(real_path)
+        self.max_depth = max(self.max_depth, len(self.chain) - self._base)
+
+    def leave(self):
+        self.chain.pop()
+
+    # the mtime and content of a file, prefetched or read now. the content is
+    # None for files streamed from disk. prefetched content is handed out once
+    # and released, later references reuse the memo or read the file again
+    def fetch(self, path, real_path):
+        fetched = self.prefetched.pop(real_path, None)
+        if fetched is not None:
+            return fetched
+        if self.read is None:
+            return os.stat(path).st_mtime_ns, None
+        return None, self.read(path)
+
+    # whether the file is sourced again after this reference
+    def _shared(self, real_path) -> bool:
+        if self.remaining is None:
+            return real_path in self.sourced
+        remaining = self.remaining.get(real_path, 1) - 1
+        self.remaining[real_path] = remaining
+        return remaining > 0
+
+    def preprocess(self, path, real_path, cache=None, engine=DEFAULT_PERMUTATION_ENGINE):
+        mtime, data = self.fetch(path, real_path)
+        key = (real_path, mtime)
+        shared = self._shared(real_path)
+        self.sourced.add(real_path)
+        commands = self.commands.get(key)
+        if commands is not None:
+            self.reused += 1
+            if not shared:
+                del self.commands[key]
+            return commands
+        if cache is not None:
+            commands = cache.preprocess_file(path, data)
+        else:
+            lines = iter_file_lines(path) if data is None else iter_data_lines(data)
+            commands = preprocess_lines(lines, engine, path)
+        return self._record(key, commands) if shared else commands
+
+    # memoizes the commands once all of them were streamed
+    def _record(self, key, commands):
+        recorded = []
+        for command in commands:
+            recorded.append(command)
+            yield command
+        self.commands[key] = recorded
+
+    def report(self) -> str:
+        return (f'sourced {len(self.sourced)} file(s) {self.references} time(s), '
+                f'{self.reused} reused, {self.skipped} skipped by source_once, '
+                f'nested {self.max_depth} deep')
 
 
-def _get_command(command: str):
-    return command[0:command.index('(')]
+PREFETCH_WORKERS = 8
+_SOURCE_PATTERN = re.compile(r'^[ \t]*source(?:_once)?\(([^)]*)\)', re.MULTILINE)
 
 
-def source(paths, parent_dir=".."):
-    to_add = []
+def _fetch(path, read=read_bytes):
+    try:
+        return os.path.realpath(path), (os.stat(path).st_mtime_ns, read(path))
+    except OSError:
+        return None
+
+
+def _scan_sources(data: bytes, directory):
+    for match in _SOURCE_PATTERN.finditer(data.decode(errors='replace')):
+        for path in match.group(1).split(','):
+            path = path.strip()
+            if path:
+                yield os.path.normpath(os.path.join(directory, os.path.expanduser(path)))
+
+
+# reads the config and every file it sources, directly or not, with up to workers
+# threads before preprocessing starts, so the latency of slow mounts overlaps
+# instead of adding up file by file. sources are found by a quick scan for
+# source(...) lines that may also pick up commented out ones, files that can't
+# be read are left out for preprocessing to report. returns real path ->
+# (mtime, content) for IncludeGraph and, when references is given, fills it
+# with real path -> how often the scanned files source it
+def prefetch_includes(root, workers=PREFETCH_WORKERS, read=read_bytes, references=None) -> dict:
+    fetched = _fetch(root, read)
+    if fetched is None:
+        return {}
+    prefetched = dict([fetched])
+    counts = Counter(_scan_sources(fetched[1][1], os.path.dirname(root)))
+    seen = {os.path.normpath(root)}
+    includes = [path for path in counts if path not in seen and not seen.add(path)]
+    if includes and workers > 0:
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+        with ThreadPoolExecutor(workers) as executor:
+            pending = {executor.submit(_fetch, path, read): path for path in includes}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path = pending.pop(future)
+                    fetched = future.result()
+                    if fetched is None:
+                        continue
+                    prefetched[fetched[0]] = fetched[1]
+                    for include in _scan_sources(fetched[1][1], os.path.dirname(path)):
+                        counts[include] += 1
+                        if include not in seen:
+                            seen.add(include)
+                            pending[executor.submit(_fetch, include, read)] = include
+    if references is not None:
+        for path, count in counts.items():
+            real_path = os.path.realpath(path)
+            references[real_path] = references.get(real_path, 0) + count
+    return prefetched
+
+
+# nested sources are resolved relative to the directory of the file sourcing
+# them, with once set files already sourced during the run are skipped
+def source(paths, parent_dir="..", cache=None, origin=None, engine=DEFAULT_PERMUTATION_ENGINE, graph=None, once=False):
+    if graph is None:
+        graph = IncludeGraph(origin)
     for path in paths:
-        expanded_path = os.path.expanduser(path)
-        if os.path.isabs(expanded_path):
-            abs_path = expanded_path
-        else:
-            abs_path = os.path.join(parent_dir, path)
-        new_lines = read_file(abs_path)
-        new_lines = filter_lines_and_handle_sourcing(new_lines, parent_dir)
-        to_add.extend(new_lines)
-    return to_add
+        abs_path = os.path.join(parent_dir, os.path.expanduser(path))
+        real_path = graph.resolve(abs_path)
+        graph.paths.add(abs_path)
+        if cache is not None:
+            cache.add_include(origin, abs_path)
+        graph.references += 1
+        if once and real_path in graph.sourced:
+            graph.skipped += 1
+            continue
+        graph.enter(real_path)
+        try:
+            commands = graph.preprocess(abs_path, real_path, cache, engine)
+            yield from TIMINGS.iterate_file(abs_path, handle_sourcing(
+                commands, os.path.dirname(abs_path), cache, abs_path, engine, graph))
+        finally:
+            graph.leave()
+
+
+def _set_shells(shell_set: ShellSet, *shells):
+    shell_set.set_targets(shells)
+
+
+# the command expand_directives turns permutations into with --typo-table. the
+# parser never produces a name with a "(" so configs can't call it themselves
+TYPO_TABLE_COMMAND = '(typo table)'
+
+# command name -> (handler, number of parameters or None if it takes any number)
+COMMANDS = {
+    "alias": (ShellSet.add_alias, 2),
+    "abbr": (ShellSet.add_abbr, 2),
+    "set_env": (ShellSet.set_env_variable, 2),
+    "add_path": (ShellSet.add_path, 1),
+    "set_shells": (_set_shells, None),
+    "compile_path": (ShellSet.set_compile_path, 2),
+    "compile_env_path": (ShellSet.set_compile_env_path, 2),
+    "set_motion_mode": (ShellSet.set_motion_mode, 1),
+    "set_path_mode": (ShellSet.set_path_mode, 1),
+    "set_alias_mode": (ShellSet.set_alias_mode, 1),
+    "set_variable_mode": (ShellSet.set_variable_mode, 1),
+    TYPO_TABLE_COMMAND: (ShellSet.add_typos, 4),
+}
 
 
-def _execute(command: str, shell_set: ShellSet):
-    params = _get_params(command)
+def _execute(command, shell_set: ShellSet):
+    if isinstance(command, str):
+        command = tokenize_line(command)
+    entry = COMMANDS.get(command.name)
+    if entry is None:
+        raise command.error(f'unknown command: {command}')
+    handler, arity = entry
+    if command.params is None:
+        raise command.error(f'missing parameters: {command}')
+    if arity is not None and len(command.params) != arity:
+        raise command.error(
+            f'{command.name} takes {arity} parameter(s) but got {len(command.params)}: {command}')
     try:
-        if command.startswith("alias"):
-            shell_set.add_alias(*params)
-        elif command.startswith("abbr"):
-            shell_set.add_abbr(*params)
-        elif command.startswith("set_env"):
-            shell_set.set_env_variable(*params)
-        elif command.startswith("add_path"):
-            shell_set.add_path(*params)
-        elif command.startswith("set_shells"):
-            shell_set.set_targets([*params])
-        elif command.startswith("compile_path"):
-            shell_set.set_compile_path(*params)
-        elif command.startswith("set_motion_mode"):
-            shell_set.set_motion_mode(*params)
-        elif command.startswith("source"):
-            shell_set.source([*params])
-        else:
-            print(f'unknown command: {command}')
-            exit(1)
-    except Exception:
-        print(f"command:{command}, invalid parameters: {params}")
+        handler(shell_set, *command.params)
+    except (KeyError, ValueError) as e:
+        raise command.error(f'invalid parameters {command.params} for {command.name}: {e}') from e
 
 
 shell_to_command = {
@@ -514,102 +1841,1555 @@ shell_to_command = {
     "zsh": "zsh",
     "fish": "fish",
     "nu": "nu",
+    "murex": "murex",
+    "xonsh": "xonsh",
     # "cmd": "cmd.exe",
     # "powershell": "powershell.exe",
     # "pwsh": "pwsh",
 }
 
 
-def auto_detect_shells():
-    out = []
-    for name, command in shell_to_command.items():
-        if shutil.which(command):
-            out.append(name)
-    return out
+# adds a shell the config can target as name, command is the program auto
+# detection looks for on PATH and defaults to the name
+def register_shell(name, shell_class, command=None):
+    SHELLS[name] = shell_class
+    shell_to_command[name] = command or name
 
 
-def process_config(lines, shell_set):
-    for line in lines:
-        _execute(line, shell_set)
+PLUGIN_DIR = "~/.config/easy_env/plugins"
+# the files of the plugins loaded so far, see program_digest
+LOADED_PLUGINS = []
 
 
-def print_shell_set(shell_set: ShellSet):
-    toPrint = ""
-    for shell in shell_set:
-        toPrint += f'{shell.shell_name}:{shell.config_path}\n'
-        toPrint += f'{shell}\n\n'
-    print(toPrint.rstrip())
+# runs every .py file in directory and calls its register function with this
+# program, so a plugin can add shells with register_shell without editing this
+# file. returns the names of the plugins
+def load_plugins(directory=PLUGIN_DIR):
+    directory = os.path.expanduser(directory)
+    try:
+        names = sorted(name for name in os.listdir(directory) if name.endswith('.py'))
+    except OSError:
+        return []
+    import importlib.util
+    program = sys.modules[__name__]
+    for name in names:
+        spec = importlib.util.spec_from_file_location(
+            f'easy_env_plugin_{name[:-3]}', os.path.join(directory, name))
+        plugin = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(plugin)
+        plugin.register(program)
+        LOADED_PLUGINS.append(spec.origin)
+    return [name[:-3] for name in names]
+
+
+# reads every PATH directory once and looks for all the shells at the same time,
+# the result is cached keyed by PATH and the mtime of each of its directories
+# which changes whenever a program is added to or removed from one of them
+def auto_detect_shells(search_path=None, cache_path=None):
+    if search_path is None:
+        search_path = os.environ.get('PATH', os.defpath)
+    directories = list(dict.fromkeys(
+        directory or '.' for directory in search_path.split(os.pathsep)))
+    mtimes = []
+    for directory in directories:
+        try:
+            mtimes.append(os.stat(directory).st_mtime_ns)
+        except OSError:
+            mtimes.append(None)
+    key = {'version': CURRENT_VERSION, 'path': search_path,
+           'mtimes': mtimes, 'commands': shell_to_command}
+
+    if cache_path is not None:
+        try:
+            with open(cache_path, 'r') as file:
+                cached = json.load(file)
+            if cached['key'] == key:
+                return cached['shells']
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    shells = _scan_for_shells(directories)
+    if cache_path is not None:
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            _write_json_atomic(cache_path, {'key': key, 'shells': shells})
+        except OSError:
+            pass
+    return shells
+
+
+def _scan_for_shells(directories):
+    wanted = {command: name for name, command in shell_to_command.items()}
+    found = set()
+    for directory in directories:
+        try:
+            entries = os.scandir(directory)
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                name = wanted.get(entry.name)
+                if name is None or name in found:
+                    continue
+                try:
+                    if entry.is_file() and os.access(entry.path, os.X_OK):
+                        found.add(name)
+                except OSError:
+                    pass
+        if len(found) == len(wanted):
+            break
+    return [name for name in shell_to_command if name in found]
+
+
+# executes every command and returns the errors instead of stopping at the first
+# one, an error raised while preprocessing ends the run since the rest of the
+# config can't be produced
+def process_config(commands, shell_set) -> list:
+    errors = []
+    with TIMINGS.stage('execution'):
+        try:
+            for command in commands:
+                try:
+                    _execute(command, shell_set)
+                except ConfigError as e:
+                    errors.append(e)
+        except ConfigError as e:
+            errors.append(e)
+        if not errors:
+            errors = shell_set.variable_errors()
+    return errors
+
+
+# holds back trailing whitespace so the output can be streamed and still end
+# without the blank lines that separate the shells
+class _RstripSink:
+    def __init__(self, sink):
+        self.sink = sink
+        self.pending = ''
+
+    def write(self, text: str):
+        stripped = text.rstrip()
+        if stripped:
+            self.sink.write(f'{self.pending}{stripped}')
+            self.pending = text[len(stripped):]
+        else:
+            self.pending += text
+
+
+def print_shell_set(shell_set: ShellSet, sink=None, jobs=1):
+    sink = _RstripSink(text_sink(sink or sys.stdout))
+    outputs = [(shell.shell_name, path, render)
+               for shell in shell_set for path, render in shell.outputs()]
+    if jobs > 1:
+        rendered = _run_jobs(_render_to_string, [render for _, _, render in outputs], jobs)
+        errors = [(path, error)
+                  for (_, path, _), (_, error) in zip(outputs, rendered) if error]
+        if errors:
+            raise OutputError(errors)
+        renders = [partial(_write_string, content) for content, _ in rendered]
+    else:
+        renders = [render for _, _, render in outputs]
+    for (name, path, _), render in zip(outputs, renders):
+        sink.write(f'{name}:{path}\n')
+        render(sink)
+        sink.write('\n\n')
+    sink.sink.write('\n')
+
+
+class FsyncMode(Enum):
+    EACH = "each"
+    BATCH = "batch"
+    NEVER = "never"
+
+
+# renders are compared against what is already on disk so unchanged files keep
+# their mtime, changed files are written to a temp file in the same directory
+# and renamed over the target so a crash never leaves a truncated config
+class OutputWriter:
+    def __init__(self, fsync=FsyncMode.BATCH):
+        self.fsync = FsyncMode(fsync)
+        self.outputs = {}
+        self.written = []
+        self.skipped = []
+        self._pending = []
+        umask = os.umask(0)
+        os.umask(umask)
+        self._new_file_mode = 0o666 & ~umask
+
+    def write(self, path, content: str):
+        self.render(path, lambda sink: sink.write(content))
+
+    def render(self, path, render):
+        self.record(self.prepare(path, render))
+
+    # render is called with a sink to stream the new content into, the content
+    # is compared against the existing file as it arrives and a temp file is
+    # only started at the first difference. prepare doesn't touch the writer's
+    # state so outputs can be prepared from several threads and recorded in order
+    def prepare(self, path, render):
+        sink = _ChangeDetectingSink(path)
+        try:
+            render(sink)
+            sink.changed = sink.finish(self.fsync == FsyncMode.EACH)
+            if sink.changed:
+                try:
+                    mode = os.stat(path).st_mode & 0o7777
+                except OSError:
+                    mode = self._new_file_mode
+                os.chmod(sink.tmp_path, mode)
+        except BaseException:
+            sink.discard()
+            raise
+        return sink
+
+    def record(self, sink):
+        self.outputs[sink.path] = sink.digest.hexdigest()
+        if not sink.changed:
+            self.skipped.append(sink.path)
+            return
+        self._pending.append((sink.tmp_path, sink.target))
+        if self.fsync != FsyncMode.BATCH:
+            self._replace(sink.tmp_path, sink.target)
+
+    def _replace(self, tmp_path, path):
+        os.replace(tmp_path, path)
+        self.written.append(path)
+        if self.fsync == FsyncMode.EACH:
+            _fsync_directory(os.path.dirname(path))
+
+    def commit(self):
+        pending, self._pending = self._pending, []
+        if self.fsync != FsyncMode.BATCH:
+            return
+        for tmp_path, _ in pending:
+            fd = os.open(tmp_path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        for tmp_path, path in pending:
+            self._replace(tmp_path, path)
+        for directory in {os.path.dirname(path) for _, path in pending}:
+            _fsync_directory(directory)
+
+    def abort(self):
+        for tmp_path, _ in self._pending:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self._pending = []
+
+    def report(self) -> str:
+        out = [f'wrote {len(self.written)} changed output(s), '
+               f'skipped {len(self.skipped)} unchanged output(s)']
+        for path in self.skipped:
+            out.append(f'skipped writing: {path}')
+        return '\n'.join(out)
+
+
+class _ChangeDetectingSink:
+    def __init__(self, path):
+        self.path = path
+        # outputs that are symlinks, like dotfiles managed by stow or
+        # home-manager, are written through so the link stays a link
+        self.target = os.path.realpath(path)
+        self.digest = hashlib.sha256()
+        self.changed = None
+        self.size = 0
+        self.tmp_path = None
+        self._tmp_file = None
+        self._matched = 0
+        try:
+            self._existing = open(self.target, 'rb')
+        except OSError:
+            self._existing = None
+
+    def write(self, text: str):
+        data = text.encode()
+        self.digest.update(data)
+        self.size += len(data)
+        if self._tmp_file is None:
+            if self._existing is not None and self._existing.read(len(data)) == data:
+                self._matched += len(data)
+                return
+            self._start_temp()
+        self._tmp_file.write(data)
+
+    def _start_temp(self):
+        import tempfile
+        fd, self.tmp_path = tempfile.mkstemp(dir=os.path.dirname(
+            self.target), prefix=f'.{os.path.basename(self.target)}.', suffix='.tmp')
+        self._tmp_file = os.fdopen(fd, 'wb')
+        if self._existing is not None:
+            self._existing.seek(0)
+            remaining = self._matched
+            while remaining > 0:
+                chunk = self._existing.read(min(remaining, 1 << 16))
+                self._tmp_file.write(chunk)
+                remaining -= len(chunk)
+
+    def finish(self, fsync: bool) -> bool:
+        if self._tmp_file is None:
+            if self._existing is not None and self._existing.read(1) == b'':
+                self._existing.close()
+                return False
+            self._start_temp()
+        if self._existing is not None:
+            self._existing.close()
+        self._tmp_file.flush()
+        if fsync:
+            os.fsync(self._tmp_file.fileno())
+        self._tmp_file.close()
+        return True
+
+    def discard(self):
+        if self._existing is not None:
+            self._existing.close()
+        if self._tmp_file is not None:
+            self._tmp_file.close()
+        if self.tmp_path is not None and os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+def _fsync_directory(directory):
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class OutputError(Exception):
+    def __init__(self, errors):
+        super().__init__(errors)
+        # (output path, exception) for every output that failed
+        self.errors = errors
+
+    def __str__(self):
+        return '\n'.join(f'{path}: {error}' for path, error in self.errors)
+
+
+# runs function over items on a pool of jobs workers, or inline for a single
+# job, and returns (result, error) pairs in the order of items
+def _run_jobs(function, items, jobs=1):
+    if jobs <= 1:
+        return [_call_job(function, item) for item in items]
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(jobs) as executor:
+        futures = [executor.submit(_call_job, function, item)
+                   for item in items]
+    return [future.result() for future in futures]
+
+
+def _call_job(function, item):
+    try:
+        return function(item), None
+    except Exception as e:
+        return None, e
 
 
-def write_shell_set(shell_set: ShellSet):
+def _prepare_output(writer: OutputWriter, name, path, render):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.isdir(path):
+        raise IsADirectoryError(f'cannot overrde directory {path}')
+    with TIMINGS.stage(f'rendering {name}'):
+        return writer.prepare(path, render)
+
+
+# (name, path, render) for every file of every updated shell, the files of a
+# shell that writes more than one are named after their part like "bash environment"
+def _shell_outputs(shell_set: ShellSet):
     for shell in shell_set:
-        config_path = os.path.expanduser(shell.config_path)
-        os.makedirs(os.path.dirname(config_path), exist_ok=True)
-        if os.path.exists(config_path) and os.path.isdir(config_path):
-            print(f'cannot overrde directory{config_path}')
-            exit(1)
-        with open(config_path, 'w') as file:
-            file.write(str(shell))
-
-
-def remove_comments(s):
-    match = re.search(r'(?<!\\)#', s)
-    if match:
-        return s[:match.start()]
-    else:
-        return s
+        outputs = shell.outputs()
+        for path, render in outputs:
+            name = shell.shell_name
+            if len(outputs) > 1:
+                name += ' ' + render.__name__.removeprefix('render_')
+            yield name, path, render
+
+
+def _render_to_string(render) -> str:
+    buffer = io.StringIO()
+    render(buffer)
+    return buffer.getvalue()
+
+
+# with jobs > 1 every output is rendered and compared on its own thread and is
+# recorded in the shell set's order so the result doesn't depend on which
+# worker finished first
+def write_shell_set(shell_set: ShellSet, writer: OutputWriter = None, jobs=1) -> dict:
+    writer = writer or OutputWriter()
+    outputs = [(name, os.path.expanduser(path), render)
+               for name, path, render in _shell_outputs(shell_set)]
+    names = [name for name, _, _ in outputs]
+    paths = [path for _, path, _ in outputs]
+    renders = [render for _, _, render in outputs]
+    results = _run_jobs(lambda job: _prepare_output(
+        writer, *job), list(zip(names, paths, renders)), jobs)
+    errors = [(path, error)
+              for path, (_, error) in zip(paths, results) if error]
+    if errors:
+        for sink, _ in results:
+            if sink is not None:
+                sink.discard()
+        raise OutputError(errors)
 
+    try:
+        with TIMINGS.stage('writing'):
+            for sink, _ in results:
+                writer.record(sink)
+                TIMINGS.count(
+                    f'bytes {"written" if sink.changed else "unchanged"}: {sink.path}', sink.size)
+            writer.commit()
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.outputs
 
-def filter_lines_and_handle_sourcing(lines, parent_dir=".."):
-    out = []
-    for line in lines:
-        line = remove_comments(line)
-        line = line.strip()
-        line = re.sub(r'\\#', '#', line)
 
-        last_paran = line.rfind(')')
-        arrow = line.rfind('->')
-        directives = []
-        if arrow > last_paran:
-            directives = line[arrow + 2:].strip().split(',')
-            line = line[0: last_paran+1]
+def _write_string(content, sink):
+    sink.write(content)
 
-        should_add: bool = True
 
-        if 'permutate key' in directives:
-            key, value = _get_params(line)
-            command = _get_command(line)
+def default_cache_dir():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or '~/.cache'
+    return os.path.join(os.path.expanduser(cache_home), 'easy_env')
 
-            keys = {''.join(p) for p in permutations(key)}
 
-            for permutation in keys:
-                out.append(f'{command}({permutation}, {value})')
+def digest_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
 
-            should_add = False
 
-        if 'other key permutations' in directives:
-            key, value = _get_params(line)
-            command = _get_command(line)
+def digest_file(path):
+    try:
+        with open(path, 'rb') as file:
+            return hashlib.file_digest(file, 'sha256').hexdigest()
+    except OSError:
+        return None
+
+
+# what the build cache was written by, the source of this program and of every
+# loaded plugin, so upgrading either rebuilds instead of reusing old outputs
+def program_digest() -> str:
+    digests = [digest_file(os.path.realpath(__file__))]
+    digests += [digest_file(path) for path in LOADED_PLUGINS]
+    return digest_bytes(':'.join(map(str, digests)).encode())
+
+
+def _write_json_atomic(path, data):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(data, file)
+    os.replace(tmp_path, path)
+
+
+# persistent manifest of the last build for one root config, the include graph
+# and per file hashes let an unchanged run exit early and let a partially
+# changed run reuse the preprocessed lines of every file that did not change
+class BuildCache:
+    def __init__(self, config_path, cache_dir=None, engine=DEFAULT_PERMUTATION_ENGINE):
+        self.config_path = config_path
+        self.engine = engine
+        cache_dir = cache_dir or default_cache_dir()
+        key = digest_bytes(config_path.encode())[:16]
+        self.directory = os.path.join(cache_dir, key)
+        self.objects_dir = os.path.join(self.directory, 'objects')
+        self.manifest_path = os.path.join(self.directory, 'manifest.json')
+        self.version = program_digest()
+        self.manifest = self._load_manifest()
+        self.files = {}
+        self.includes = {}
+        self.reused = []
+        self.rebuilt = []
+
+    def _load_manifest(self) -> dict:
+        try:
+            with open(self.manifest_path, 'r') as file:
+                manifest = json.load(file)
+        except (OSError, ValueError):
+            return {}
+        if manifest.get('version') != self.version:
+            return {}
+        return manifest
+
+    def up_to_date(self, shells) -> bool:
+        manifest = self.manifest
+        if manifest.get('config') != self.config_path:
+            return False
+        if manifest.get('shells') != sorted(shells):
+            return False
+        if manifest.get('engine') != self.engine.key():
+            return False
+        for path, digest in manifest['files'].items():
+            if digest_file(path) != digest:
+                return False
+        for path, digest in manifest['outputs'].items():
+            if digest_file(path) != digest:
+                return False
+        return True
 
-            keys = {''.join(p) for p in permutations(key)}
+    def add_include(self, origin, path):
+        self.includes.setdefault(origin, []).append(path)
+
+    def _object_name(self, digest):
+        return digest_bytes(f'{self.version}:{self.engine.key()}:{digest}'.encode())
+
+    # hashes the file up front and returns a lazy iterator over its preprocessed
+    # commands, either streamed from the object store or preprocessed while
+    # being streamed into it
+    def preprocess_file(self, path, data=None):
+        digest = digest_file(path) if data is None else digest_bytes(data)
+        if digest is None:
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        self.files[path] = digest
+        object_path = os.path.join(self.objects_dir, self._object_name(digest))
+        if os.path.isfile(object_path):
+            self.reused.append(path)
+            return (Command.from_json(line, path) for line in iter_file_lines(object_path))
+        self.rebuilt.append(path)
+        lines = iter_file_lines(path) if data is None else iter_data_lines(data)
+        commands = preprocess_lines(lines, self.engine, path)
+        return self._store_object(object_path, commands)
+
+    def _store_object(self, object_path, commands):
+        os.makedirs(self.objects_dir, exist_ok=True)
+        tmp_path = f'{object_path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'w') as file:
+                for command in commands:
+                    file.write(f'{command.to_json()}\n')
+                    yield command
+            os.replace(tmp_path, object_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def save(self, shells, outputs: dict):
+        os.makedirs(self.objects_dir, exist_ok=True)
+        manifest = {
+            'version': self.version,
+            'config': self.config_path,
+            'shells': sorted(shells),
+            'engine': self.engine.key(),
+            'includes': self.includes,
+            'files': self.files,
+            'outputs': outputs,
+        }
+        _write_json_atomic(self.manifest_path, manifest)
+        self.manifest = manifest
+
+        referenced = {self._object_name(digest)
+                      for digest in self.files.values()}
+        for name in os.listdir(self.objects_dir):
+            if name not in referenced:
+                os.remove(os.path.join(self.objects_dir, name))
+
+    def report(self) -> str:
+        out = [f'preprocessed {len(self.rebuilt)} changed file(s), '
+               f'reused {len(self.reused)} unchanged file(s)']
+        for path in self.reused:
+            out.append(f'skipped preprocessing: {path}')
+        return '\n'.join(out)
+
+
+def filter_lines_and_handle_sourcing(lines, parent_dir="..", engine=DEFAULT_PERMUTATION_ENGINE):
+    commands = handle_sourcing(preprocess_lines(
+        lines, engine), parent_dir, engine=engine)
+    return (str(command) for command in commands)
+
+
+def handle_sourcing(commands, parent_dir="..", cache=None, origin=None, engine=DEFAULT_PERMUTATION_ENGINE, graph=None):
+    if graph is None:
+        graph = IncludeGraph(origin)
+    for command in commands:
+        if command.name in ("source", "source_once") and command.params is not None:
+            try:
+                yield from source(command.params, parent_dir, cache, origin, engine,
+                                  graph, once=command.name == "source_once")
+            except OSError as e:
+                raise command.error(
+                    f'cannot source {e.filename}: {e.strerror}') from e
+            except IncludeCycleError as e:
+                raise command.error(str(e)) from e
+        else:
+            yield command
+
+
+def expand_directives(commands, engine=DEFAULT_PERMUTATION_ENGINE):
+    for command in commands:
+        if not command.directives:
+            yield command
+            continue
+
+        for directive in command.directives:
+            if directive not in PERMUTATION_DIRECTIVES:
+                raise command.error(f'unknown directive: {directive}')
+            if command.params is None or len(command.params) != 2:
+                raise command.error(
+                    f'{directive} only works with a key and a value: {command}')
+            key, value = command.params
+            try:
+                permutations = engine.permutations(key)
+            except PermutationLimitError as e:
+                raise command.error(str(e)) from e
+            if engine.typo_table and command.name in ('alias', 'abbr'):
+                TIMINGS.count('typo table entries', 1)
+                yield Command(TYPO_TABLE_COMMAND, (command.name, key, value, directive), (),
+                              command.path, command.line_number)
+                continue
+
+            generated = 0
+            for permutation in permutations:
+                if directive == 'other key permutations' and permutation == key:
+                    continue
+                generated += 1
+                yield Command(command.name, (permutation, value), (), command.path, command.line_number)
+            TIMINGS.count(f'lines generated by {directive}', generated)
+
+
+# strips comments and expands directives, source(...) commands are kept so the
+# result only depends on the file's own content and can be cached per file.
+# every stage of the pipeline is a generator so a config is never held in memory
+def preprocess_lines(lines, engine=DEFAULT_PERMUTATION_ENGINE, path=None):
+    lines = TIMINGS.iterate('reading', lines)
+    commands = TIMINGS.iterate('parsing', parse_lines(lines, path))
+    return TIMINGS.iterate('directive expansion', expand_directives(commands, engine))
+
+
+class CompileError(Exception):
+    def __init__(self, errors):
+        super().__init__(errors)
+        # the ConfigError of every line that failed
+        self.errors = errors
 
-            for permutation in keys:
-                if permutation != key:
-                    out.append(f'{command}({permutation}, {value})')
+    def __str__(self):
+        return '\n'.join(str(error) for error in self.errors)
+
+
+def _read_file(contents, path) -> bytes:
+    data = contents.get(os.path.normpath(path))
+    if data is None:
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+    return data
+
+
+# compiles a config in memory and returns {output name: content}, for programs
+# embedding the compiler. config is the text of the root config and path the
+# name errors report it under. sourced files are looked up in files, {path
+# relative to the root config: text}, or read from disk relative to path when
+# files is None. nothing is detected, printed or written and no state is kept
+# between calls, so it can be called from many threads at once. outputs are
+# named like in --timings, "bash" or "bash environment" and "bash interactive"
+# with compile_env_path. raises CompileError with every error in the config
+def compile(config: str, shells=None, files=None, path='easy.conf',
+            engine=DEFAULT_PERMUTATION_ENGINE) -> dict:
+    if files is None:
+        graph = IncludeGraph(path)
+    else:
+        directory = os.path.dirname(path)
+        contents = {os.path.normpath(os.path.join(directory, name)): text.encode()
+                    for name, text in files.items()}
+        graph = IncludeGraph(path, read=partial(_read_file, contents), resolve=os.path.normpath)
+    shell_set = ShellSet(shells)
+    commands = handle_sourcing(preprocess_lines(io.StringIO(config), engine, path),
+                               os.path.dirname(path), engine=engine, graph=graph)
+    errors = process_config(commands, shell_set)
+    if errors:
+        raise CompileError(errors)
+    return {name: _render_to_string(render) for name, _, render in _shell_outputs(shell_set)}
+
+
+# the files of a bundle that source(...) lines reach from config, found the same
+# way prefetch_includes finds them, keyed by their normalized path
+def _reachable_files(config, files, path='easy.conf') -> dict:
+    directory = os.path.dirname(path)
+    by_path = {os.path.normpath(os.path.join(directory, name)): text
+               for name, text in files.items()}
+    reachable = {}
+    pending = list(_scan_sources(config.encode(), directory))
+    while pending:
+        include = pending.pop()
+        if include in reachable or include not in by_path:
+            continue
+        reachable[include] = by_path[include]
+        pending.extend(_scan_sources(
+            reachable[include].encode(), os.path.dirname(include)))
+    return reachable
+
+
+class LRUCache:
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# request counts and the latencies of the last window requests
+class ServerMetrics:
+    def __init__(self, window=1000):
+        self.requests = 0
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=window)
+
+    def record(self, seconds, hit=False, failed=False):
+        self.requests += 1
+        self.hits += hit
+        self.misses += not hit
+        self.errors += failed
+        self.latencies.append(seconds)
+
+    def to_json(self) -> dict:
+        latencies = sorted(self.latencies)
+
+        def percentile(fraction):
+            if not latencies:
+                return 0
+            return latencies[min(int(len(latencies) * fraction), len(latencies) - 1)] * 1000
+
+        return {
+            'requests': self.requests,
+            'hits': self.hits,
+            'misses': self.misses,
+            'errors': self.errors,
+            'hit_rate': self.hits / self.requests if self.requests else 0,
+            'latency_ms': {
+                'mean': sum(latencies) / len(latencies) * 1000 if latencies else 0,
+                'p50': percentile(0.5),
+                'p95': percentile(0.95),
+                'p99': percentile(0.99),
+                'max': latencies[-1] * 1000 if latencies else 0,
+            },
+        }
+
+
+MAX_REQUEST_SIZE = 16 * 1024 * 1024
+
+
+# compiles config bundles sent over HTTP on a unix socket or localhost:
+#   POST /compile {"config": text, "files": {path: text}, "shells": [name],
+#                  "path": name, "max_permutation_key_length": n,
+#                  "max_permutations": n, "typo_table": bool}
+#     -> 200 {"outputs": {name: content}} or 422 {"errors": [message]}
+#   GET /metrics -> request counts, cache hit rate and latencies
+# results are kept in an LRU cache keyed by the hash of the config, every file
+# it sources and the options, compiling runs on worker threads. bodies larger
+# than max_request_size bytes are answered with 413 and the connection closed
+class CompileServer:
+    def __init__(self, cache_size=256, max_request_size=MAX_REQUEST_SIZE):
+        self.cache = LRUCache(cache_size)
+        self.metrics = ServerMetrics()
+        self.max_request_size = max_request_size
+
+    @staticmethod
+    def bundle_key(bundle: dict) -> str:
+        path = bundle.get('path', 'easy.conf')
+        shells = bundle.get('shells')
+        resolved = {
+            'config': bundle['config'],
+            'files': _reachable_files(bundle['config'], bundle.get('files') or {}, path),
+            'shells': None if shells is None else sorted(shells),
+            'path': path,
+            'limits': [bundle.get('max_permutation_key_length'), bundle.get('max_permutations')],
+            'typo_table': bool(bundle.get('typo_table')),
+        }
+        return digest_bytes(json.dumps(resolved, sort_keys=True).encode())
+
+    @staticmethod
+    def compile_bundle(bundle: dict) -> dict:
+        engine = PermutationEngine(bundle.get('max_permutation_key_length') or 12,
+                                   bundle.get('max_permutations') or 100_000,
+                                   bool(bundle.get('typo_table')))
+        return compile(bundle['config'], bundle.get('shells'), bundle.get('files') or {},
+                       bundle.get('path', 'easy.conf'), engine)
+
+    async def respond(self, method, target, body: bytes):
+        import asyncio
+        if target == '/metrics' and method == 'GET':
+            metrics = self.metrics.to_json()
+            metrics['cache_entries'] = len(self.cache)
+            return 200, metrics
+        if target != '/compile' or method != 'POST':
+            return 404, {'error': f'no {method} {target}'}
+        start = time.perf_counter()
+        try:
+            bundle = json.loads(body)
+            key = self.bundle_key(bundle)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self.metrics.record(time.perf_counter() - start, failed=True)
+            return 400, {'error': f'invalid bundle: {e}'}
+        outputs = self.cache.get(key)
+        hit = outputs is not None
+        if not hit:
+            try:
+                outputs = await asyncio.get_running_loop().run_in_executor(
+                    None, self.compile_bundle, bundle)
+            except CompileError as e:
+                self.metrics.record(time.perf_counter() - start, failed=True)
+                return 422, {'errors': [str(error) for error in e.errors]}
+            except (ValueError, KeyError, TypeError) as e:
+                self.metrics.record(time.perf_counter() - start, failed=True)
+                return 400, {'error': f'invalid bundle: {e!r}'}
+            self.cache.put(key, outputs)
+        self.metrics.record(time.perf_counter() - start, hit)
+        return 200, {'outputs': outputs}
+
+    # a minimal HTTP/1.1 server, connections are kept open between requests
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0))
+                if length < 0:
+                    raise ValueError(f'negative content length: {length}')
+                if length > self.max_request_size:
+                    # the body is never read, so the connection can't be reused
+                    await self._write_response(writer, 413, {
+                        'error': f'request body larger than {self.max_request_size} bytes'})
+                    break
+                body = await reader.readexactly(length)
+                status, response = await self.respond(method, target, body)
+                await self._write_response(writer, status, response)
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ValueError, ConnectionError, EOFError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _write_response(writer, status, response):
+        content = json.dumps(response).encode()
+        writer.write(f'HTTP/1.1 {status} {_HTTP_REASONS[status]}\r\n'
+                     f'Content-Type: application/json\r\n'
+                     f'Content-Length: {len(content)}\r\n\r\n'.encode() + content)
+        await writer.drain()
+
+    async def serve(self, address, ready=None):
+        import asyncio
+        if os.sep in address:
+            # a socket left behind by an earlier server is replaced, anything
+            # else at the address makes binding fail instead of being deleted
+            try:
+                if stat.S_ISSOCK(os.lstat(address).st_mode):
+                    os.remove(address)
+            except FileNotFoundError:
+                pass
+            server = await asyncio.start_unix_server(self.handle, address)
+        else:
+            host, _, port = address.rpartition(':')
+            server = await asyncio.start_server(self.handle, host or '127.0.0.1', int(port))
+        if ready is not None:
+            ready()
+        async with server:
+            await server.serve_forever()
 
-            should_add = False
 
-        if line.startswith("source"):
-            params = _get_params(line)
-            out.extend(source([*params], parent_dir))
-            should_add = False
+_HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 413: 'Content Too Large',
+                 422: 'Unprocessable Entity'}
 
-        if should_add and line != '':
-            out.append(line)
-    return out
+
+def serve(args):
+    import asyncio
+    server = CompileServer(args.server_cache_size)
+    print(f'serving on {args.serve}', file=sys.stderr)
+    try:
+        asyncio.run(server.serve(args.serve))
+    except KeyboardInterrupt:
+        pass
+
+
+# waits for changes with inotify, watching the directories of the files instead
+# of the files themselves so editors that save by renaming a new file over the
+# old one are noticed too
+class InotifyWatcher:
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        self._libc = ctypes.CDLL(ctypes.util.find_library(
+            'c') or 'libc.so.6', use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.files = set()
+        self._directories = {}
+
+    def set_files(self, files):
+        self.files = {os.path.realpath(path) for path in files}
+        directories = {os.path.dirname(path) for path in self.files}
+        for directory in directories - set(self._directories.values()):
+            wd = self._libc.inotify_add_watch(
+                self.fd, os.fsencode(directory), self.MASK)
+            if wd >= 0:
+                self._directories[wd] = directory
+        for wd, directory in list(self._directories.items()):
+            if directory not in directories:
+                self._libc.inotify_rm_watch(self.fd, wd)
+                del self._directories[wd]
+
+    # blocks until one of the files changes or timeout seconds pass and returns
+    # the changed files, an empty set on timeout
+    def wait(self, timeout=None) -> set:
+        import select
+        import struct
+        changed = set()
+        while not changed:
+            ready, _, _ = select.select([self.fd], [], [], timeout)
+            if not ready:
+                return changed
+            data = os.read(self.fd, 1 << 16)
+            offset = 0
+            while offset < len(data):
+                wd, _, _, length = struct.unpack_from('iIII', data, offset)
+                offset += 16
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                directory = self._directories.get(wd)
+                if directory is not None:
+                    path = os.path.join(directory, name)
+                    if path in self.files:
+                        changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+# fallback where inotify isn't available, stats the files every interval seconds
+class PollingWatcher:
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self._stats = {}
+
+    @staticmethod
+    def _stat(path):
+        try:
+            stat = os.stat(path)
+            return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        except OSError:
+            return None
+
+    def set_files(self, files):
+        self._stats = {os.path.realpath(path): self._stat(path)
+                       for path in files}
+
+    def wait(self, timeout=None) -> set:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            changed = set()
+            for path, stat in self._stats.items():
+                current = self._stat(path)
+                if current != stat:
+                    self._stats[path] = current
+                    changed.add(path)
+            if changed:
+                return changed
+            if deadline is not None and time.monotonic() >= deadline:
+                return changed
+            delay = self.interval if deadline is None else min(
+                self.interval, max(deadline - time.monotonic(), 0))
+            time.sleep(delay)
+
+    def close(self):
+        pass
+
+
+def make_watcher():
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher()
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher()
+
+
+# seconds without further changes before rebuilding, editors often write a file
+# several times when saving it
+WATCH_DEBOUNCE = 0.2
+
+
+def watch(args):
+    if args.no_cache:
+        print('--watch needs the build cache, it can\'t be used with --no-cache', file=sys.stderr)
+        exit(1)
+    watcher = make_watcher()
+    try:
+        while True:
+            watched = set()
+            build(args, watched)
+            watcher.set_files(watched)
+            changed = watcher.wait()
+            while True:
+                more = watcher.wait(WATCH_DEBOUNCE)
+                if not more:
+                    break
+                changed |= more
+            print(f'rebuilding after changes to {", ".join(sorted(changed))}')
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+
+def synthetic_config(aliases=1000, env_variables=100, paths=20, output_dir=None) -> list:
+    lines = []
+    if output_dir is not None:
+        for name in SHELLS:
+            lines.append(
+                f'compile_path({name}, {os.path.join(output_dir, name)})')
+    for i in range(env_variables):
+        lines.append(f'set_env(VAR_{i}, {{HOME}}/value/{i})')
+    for i in range(paths):
+        lines.append(f'add_path(~/tools/{i}/bin)')
+    for i in range(aliases):
+        if i % 2:
+            lines.append(f'alias(a{i}, git log --oneline {{VAR_{i % 100}}} | head -n {i})')
+        else:
+            lines.append(f'abbr(b{i}, ls -la ~/projects/{i})')
+    return lines
+
+
+# writes a generated config tree into directory and returns the root config,
+# aliases are spread over a chain of depth sourced files or over width files
+# sourced from the root
+def write_synthetic_tree(directory, aliases=0, depth=0, width=0, permutation_keys=0, variable_values=0) -> str:
+    def write(name, lines):
+        with open(os.path.join(directory, name), 'w') as file:
+            file.write('\n'.join(lines))
+            file.write('\n')
+
+    files = max(depth, width) + 1
+    per_file = aliases // files
+    root = synthetic_config(aliases=per_file, env_variables=100, paths=20)
+    for i in range(permutation_keys):
+        root.append(f'abbr(p{i:03d}qr, echo {i}) -> permutate key')
+    for i in range(variable_values):
+        root.append(
+            f'set_env(REF_{i}, {{HOME}}/{{VAR_{i % 100}}}/{{USER}}:{{PATH}} \\{{literal\\}})')
+    for i in range(1, files):
+        lines = [f'alias(f{i}_{j}, echo {{VAR_{j % 100}}} {j})' for j in range(per_file)]
+        if depth and i < depth:
+            lines.append(f'source(level{i + 1}.conf)')
+        write(f'level{i}.conf', lines)
+        if width or i == 1:
+            root.append(f'source(level{i}.conf)')
+    write('root.conf', root)
+    return os.path.join(directory, 'root.conf')
+
+
+BENCHMARK_SCENARIOS = {
+    'aliases_1k': {'aliases': 1_000},
+    'aliases_10k': {'aliases': 10_000},
+    'aliases_100k': {'aliases': 100_000},
+    'deep_sources': {'aliases': 10_000, 'depth': 50},
+    'wide_sources': {'aliases': 10_000, 'width': 200},
+    'permutations': {'permutation_keys': 100},
+    'variables': {'variable_values': 10_000},
+}
+
+
+class _NullSink:
+    def write(self, text):
+        pass
+
+
+def _time(function, repeat=3) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def benchmark_jobs(args):
+    import tempfile
+    jobs = max(args.jobs, 2)
+    shell_set = ShellSet()
+    process_config(parse_lines(synthetic_config(aliases=20_000)), shell_set)
+    with tempfile.TemporaryDirectory() as directory:
+        def run(jobs):
+            output_dir = tempfile.mkdtemp(dir=directory)
+            for name in shell_set.all_shells:
+                shell_set.set_compile_path(
+                    name, os.path.join(output_dir, name))
+            write_shell_set(shell_set, OutputWriter(FsyncMode.EACH), jobs)
+
+        sequential = _time(lambda: run(1))
+        results = {'sequential': sequential}
+        print(f'{"mode":<36}{"seconds":>10}{"speedup":>10}')
+        print(f'{"sequential":<36}{sequential:>10.3f}{1:>10.2f}')
+        elapsed = _time(lambda: run(jobs))
+        results[f'{jobs} threads'] = elapsed
+        print(f'{f"{jobs} threads":<36}{elapsed:>10.3f}{sequential / elapsed:>10.2f}')
+
+        # a network mounted home directory adds a round trip to every output
+        for shell in shell_set.all_shells.values():
+            shell.render = partial(_slow_render, shell.render, 0.05)
+        sequential = _time(lambda: run(1))
+        print(f'{"sequential, 50ms per output":<36}{sequential:>10.3f}{1:>10.2f}')
+        elapsed = _time(lambda: run(jobs))
+        print(f'{f"{jobs} threads, 50ms per output":<36}{elapsed:>10.3f}{sequential / elapsed:>10.2f}')
+        for shell in shell_set.all_shells.values():
+            del shell.render
+        results['sequential, 50ms per output'] = sequential
+        results[f'{jobs} threads, 50ms per output'] = elapsed
+    record_benchmark(args, 'jobs', results)
+
+
+def _slow_read(latency, path) -> bytes:
+    time.sleep(latency)
+    return read_bytes(path)
+
+
+def _preprocess_tree(root, workers, read) -> list:
+    references = {}
+    prefetched = prefetch_includes(root, workers, read, references) if workers else {}
+    graph = IncludeGraph(root, prefetched, read, references=references if workers else None)
+    mtime, data = graph.fetch(root, graph.chain[0])
+    commands = handle_sourcing(preprocess_lines(iter_data_lines(data), path=root),
+                               os.path.dirname(root), graph=graph)
+    return [str(command) for command in commands]
+
+
+# reads wide and deep source trees through a reader that sleeps before every
+# read, standing in for a network mount, once file by file and once prefetched
+def benchmark_includes(args):
+    import tempfile
+    workers = args.prefetch or PREFETCH_WORKERS
+    latency = 0.02
+    read = partial(_slow_read, latency)
+    results = {}
+    print(f'{"tree, 20ms per read":<36}{"seconds":>10}{"speedup":>10}')
+    for label, size in [('64 files wide', {'width': 64}), ('16 files deep', {'depth': 16})]:
+        with tempfile.TemporaryDirectory() as directory:
+            root = write_synthetic_tree(directory, aliases=6_400, **size)
+            expected = _preprocess_tree(root, 0, read)
+            if _preprocess_tree(root, workers, read) != expected:
+                raise AssertionError(f'prefetching changed the commands of {label}')
+            sequential = _time(lambda: _preprocess_tree(root, 0, read))
+            prefetched = _time(lambda: _preprocess_tree(root, workers, read))
+        results[f'{label}, sequential'] = sequential
+        results[f'{label}, {workers} threads'] = prefetched
+        print(f'{f"{label}, sequential":<36}{sequential:>10.3f}{1:>10.2f}')
+        print(f'{f"{label}, {workers} threads":<36}{prefetched:>10.3f}{sequential / prefetched:>10.2f}')
+    record_benchmark(args, 'includes', results)
+
+
+# calls compile on small and large configs from one thread and from a pool,
+# checking every result against the first one
+def benchmark_compile(args):
+    from concurrent.futures import ThreadPoolExecutor
+    jobs = max(args.jobs, 4)
+    configs = {
+        'small': '\n'.join(synthetic_config(aliases=50, env_variables=10, paths=5)),
+        'large': '\n'.join(synthetic_config(aliases=2_000)),
+    }
+    results = {}
+    print(f'{"config":<10}{"mode":<14}{"calls":>8}{"seconds":>10}{"calls/min":>12}')
+    for label, config in configs.items():
+        expected = compile(config)
+        calls = 2_000 if label == 'small' else 50
+        for mode, workers in [('sequential', 1), (f'{jobs} threads', jobs)]:
+            start = time.perf_counter()
+            with ThreadPoolExecutor(workers) as executor:
+                outputs = list(executor.map(compile, [config] * calls))
+            elapsed = time.perf_counter() - start
+            if any(output != expected for output in outputs):
+                raise AssertionError(f'{label} compiled differently on {mode}')
+            per_minute = calls / elapsed * 60
+            results[f'{label} {mode} calls_per_min'] = per_minute
+            print(f'{label:<10}{mode:<14}{calls:>8}{elapsed:>10.3f}{per_minute:>12.0f}')
+    record_benchmark(args, 'compile', results)
+
+
+async def _http_request(reader, writer, method, target, body=b''):
+    writer.write(f'{method} {target} HTTP/1.1\r\nHost: localhost\r\n'
+                 f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line == b'\r\n':
+            break
+        name, _, value = line.decode().partition(':')
+        if name.lower() == 'content-length':
+            length = int(value)
+    return status, json.loads(await reader.readexactly(length))
+
+
+# load tests a compile server started in its own process on a unix socket,
+# every client keeps one connection open and sends bundles picked from a few
+# distinct configs so most of them are cache hits
+def benchmark_server(args):
+    import asyncio
+    import subprocess
+    import tempfile
+    import random
+    clients, requests_per_client, distinct = 16, 200, 20
+    bundles = [json.dumps({'config': '\n'.join(synthetic_config(aliases=200 + i)),
+                           'files': {'shared.conf': 'alias(shared, true)'}}).encode()
+               for i in range(distinct)]
+
+    async def client(address, latencies):
+        reader, writer = await asyncio.open_unix_connection(address)
+        try:
+            for _ in range(requests_per_client):
+                start = time.perf_counter()
+                status, _ = await _http_request(reader, writer, 'POST', '/compile', random.choice(bundles))
+                latencies.append(time.perf_counter() - start)
+                if status != 200:
+                    raise AssertionError(f'the server answered {status}')
+        finally:
+            writer.close()
+
+    async def load(address):
+        latencies = []
+        start = time.perf_counter()
+        await asyncio.gather(*(client(address, latencies) for _ in range(clients)))
+        elapsed = time.perf_counter() - start
+        reader, writer = await asyncio.open_unix_connection(address)
+        _, metrics = await _http_request(reader, writer, 'GET', '/metrics')
+        writer.close()
+        return elapsed, sorted(latencies), metrics
+
+    with tempfile.TemporaryDirectory() as directory:
+        address = os.path.join(directory, 'server.sock')
+        script = os.path.realpath(__file__)
+        server = subprocess.Popen([sys.executable, script, '--serve', address],
+                                  stderr=subprocess.DEVNULL)
+        try:
+            while not os.path.exists(address):
+                time.sleep(0.01)
+            elapsed, latencies, metrics = asyncio.run(load(address))
+        finally:
+            server.terminate()
+            server.wait()
+        config = os.path.join(directory, 'config.conf')
+        with open(config, 'w') as file:
+            file.write('\n'.join(synthetic_config(aliases=200)))
+        process_ms = _median_run_ms([sys.executable, script, '-p', '--no-cache', config], runs=5)
+
+    total = clients * requests_per_client
+    results = {
+        'requests': total,
+        'requests_per_second': total / elapsed,
+        'client_p50_ms': latencies[len(latencies) // 2] * 1000,
+        'client_p99_ms': latencies[int(len(latencies) * 0.99)] * 1000,
+        'server_hit_rate': metrics['hit_rate'],
+        'server_mean_ms': metrics['latency_ms']['mean'],
+        'process_per_config_ms': process_ms,
+    }
+    for name, value in results.items():
+        print(f'{name:<24}{value:>12.2f}')
+    record_benchmark(args, 'server', results)
+
+
+def _slow_render(render, latency, sink):
+    time.sleep(latency)
+    render(sink)
+
+
+# times every stage of one scenario separately and keeps the best of repeat
+# runs, with a spread dict the distance from the best to the median run of each
+# stage is stored there as a measure of how noisy it is
+def benchmark_scenario(root, output_dir, repeat=7, spread=None) -> dict:
+    samples = {}
+
+    def measure(stage, function):
+        start = time.perf_counter()
+        result = function()
+        samples.setdefault(stage, []).append(time.perf_counter() - start)
+        return result
+
+    for _ in range(repeat):
+        commands = measure('filter_lines_and_handle_sourcing', lambda: list(handle_sourcing(
+            preprocess_lines(iter_file_lines(root), path=root), os.path.dirname(root))))
+        shell_set = ShellSet()
+        errors = measure('process_config', lambda: process_config(commands, shell_set))
+        if errors:
+            raise errors[0]
+        for shell in shell_set:
+            measure(f'render_{shell.shell_name}', lambda: shell.render(_NullSink()))
+        for name in shell_set.all_shells:
+            shell_set.set_compile_path(name, os.path.join(output_dir, name))
+        # a fresh writer and new content every run so every output is written
+        shell_set.set_targets(list(shell_set.all_shells))
+        shell_set.add_alias('benchmark_run', str(time.perf_counter_ns()))
+        measure('write_shell_set', lambda: write_shell_set(
+            shell_set, OutputWriter(FsyncMode.NEVER)))
+    if spread is not None:
+        for stage, times in samples.items():
+            times.sort()
+            spread[stage] = times[len(times) // 2] - times[0]
+    return {stage: min(times) for stage, times in samples.items()}
+
+
+# how many times its measured spread a stage has to be slower than the
+# baseline before it counts, filesystem bound stages vary a lot between runs
+NOISE_SPREADS = 3
+
+
+# a stage regresses when it is more than threshold slower than the baseline and
+# the difference is over both the noise floor and NOISE_SPREADS times the
+# stage's spread in spreads
+def compare_to_baseline(results: dict, baseline: dict, threshold: float,
+                        noise_floor=0.002, spreads=None) -> list:
+    regressions = []
+    for scenario, stages in results.items():
+        for stage, seconds in stages.items():
+            expected = baseline.get(scenario, {}).get(stage)
+            if expected is None:
+                continue
+            noise = noise_floor
+            if spreads is not None:
+                noise = max(noise, NOISE_SPREADS * spreads.get(scenario, {}).get(stage, 0))
+            if seconds > expected * (1 + threshold) and seconds - expected > noise:
+                regressions.append(
+                    f'{scenario} {stage}: {seconds * 1000:.1f}ms, baseline {expected * 1000:.1f}ms '
+                    f'(+{(seconds / expected - 1) * 100:.0f}%)')
+    return regressions
+
+
+def benchmark_suite(args):
+    import tempfile
+    scenarios = [name for name in BENCHMARK_SCENARIOS
+                 if not args.benchmark_filter or args.benchmark_filter in name]
+    results = {}
+    spreads = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for scenario in scenarios:
+            scenario_dir = os.path.join(directory, scenario)
+            os.makedirs(os.path.join(scenario_dir, 'out'))
+            root = write_synthetic_tree(
+                scenario_dir, **BENCHMARK_SCENARIOS[scenario])
+            spreads[scenario] = {}
+            results[scenario] = benchmark_scenario(
+                root, os.path.join(scenario_dir, 'out'), spread=spreads[scenario])
+            for stage, seconds in results[scenario].items():
+                print(f'{scenario:<16}{stage:<36}{seconds * 1000:>10.1f}ms')
+    record_benchmark(args, 'suite', results)
+
+    if not args.benchmark_baseline:
+        return
+    if args.update_baseline or not os.path.exists(args.benchmark_baseline):
+        baseline = {}
+        if os.path.exists(args.benchmark_baseline):
+            with open(args.benchmark_baseline, 'r') as file:
+                baseline = json.load(file)
+        baseline.update(results)
+        _write_json_atomic(args.benchmark_baseline, baseline)
+        print(f'saved baseline to {args.benchmark_baseline}')
+        return
+    with open(args.benchmark_baseline, 'r') as file:
+        baseline = json.load(file)
+    regressions = compare_to_baseline(
+        results, baseline, args.benchmark_threshold, spreads=spreads)
+    for regression in regressions:
+        print(f'regression: {regression}')
+    if regressions:
+        exit(1)
+    print(f'no regressions over {args.benchmark_threshold:.0%} of the baseline')
+
+
+# milliseconds the launcher may add on top of a bare interpreter start for -v
+STARTUP_BUDGET_MS = 40
+
+
+def _median_run_ms(command, runs=15) -> float:
+    import subprocess
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL, check=True)
+        times.append((time.perf_counter() - start) * 1000)
+    return sorted(times)[len(times) // 2]
+
+
+def _import_time_ms(launcher) -> float:
+    import subprocess
+    result = subprocess.run([sys.executable, '-X', 'importtime', launcher, '-v'],
+                            capture_output=True, text=True, check=True)
+    # lines look like "import time: self [us] | cumulative | module"
+    total = 0
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            self_time = line.split(':', 1)[1].split('|')[0].strip()
+            if self_time.isdigit():
+                total += int(self_time)
+    return total / 1000
+
+
+def record_benchmark(args, name, results: dict):
+    if not args.benchmark_output:
+        return
+    record = {'benchmark': name, 'version': CURRENT_VERSION,
+              'time': time.time(), 'results': results}
+    with open(args.benchmark_output, 'a') as file:
+        file.write(f'{json.dumps(record)}\n')
+
+
+def benchmark_startup(args):
+    directory = os.path.dirname(os.path.realpath(__file__))
+    script = os.path.join(directory, 'easy-env-config.py')
+    launcher = os.path.join(directory, 'easy_env_config.py')
+    # the first run through the launcher writes the cached bytecode
+    _median_run_ms([sys.executable, launcher, '-v'], runs=1)
+
+    results = {
+        'interpreter_ms': _median_run_ms([sys.executable, '-c', 'pass']),
+        'script_version_ms': _median_run_ms([sys.executable, script, '-v']),
+        'launcher_version_ms': _median_run_ms([sys.executable, launcher, '-v']),
+        'launcher_imports_ms': _import_time_ms(launcher),
+    }
+    results['launcher_overhead_ms'] = results['launcher_version_ms'] - \
+        results['interpreter_ms']
+    for name, value in results.items():
+        print(f'{name:<24}{value:>10.1f}')
+    record_benchmark(args, 'startup', results)
+
+    if results['launcher_overhead_ms'] > STARTUP_BUDGET_MS:
+        print(f'over the startup budget of {STARTUP_BUDGET_MS}ms')
+        exit(1)
+
+
+# how each shell sources a file without reading its own config first, the file
+# is passed as an argument
+SOURCE_COMMANDS = {
+    'bash': ['bash', '--norc', '--noprofile', '-c', '. "$1"', 'bash'],
+    'zsh': ['zsh', '-f', '-c', '. "$1"', 'zsh'],
+    'fish': ['fish', '--no-config', '-c', 'source $argv[1]'],
+    'nu': ['nu', '-n', '-c', 'source-env $env.FILE'],
+}
+
+
+# sources the files generated with separate and batched aliases for a config
+# with a few thousand aliases in every installed shell and compares how long
+# that takes against an empty file
+def benchmark_sourcing(args):
+    import tempfile
+    lines = synthetic_config(aliases=3_000, env_variables=0, paths=0)
+    lines += [f'abbr(g{i:02d}it, git) -> permutate key' for i in range(20)]
+    shells = [name for name in auto_detect_shells() if name in SOURCE_COMMANDS]
+    if not shells:
+        print('none of the shells this benchmark can source are installed')
+        return
+    results = {}
+    print(f'{"shell":<8}{"mode":<12}{"aliases":>10}{"ms":>10}{"over empty":>12}')
+    with tempfile.TemporaryDirectory() as directory:
+        for mode in AliasMode:
+            shell_set = ShellSet(set(shells))
+            shell_set.set_alias_mode(mode.value)
+            errors = process_config(expand_directives(parse_lines(lines)), shell_set)
+            if errors:
+                raise errors[0]
+            for shell in shell_set:
+                path = os.path.join(directory, f'{shell.shell_name}.{mode.value}')
+                with open(path, 'w') as file:
+                    shell.render(file)
+        empty = os.path.join(directory, 'empty')
+        open(empty, 'w').close()
+        for name in shells:
+            command = SOURCE_COMMANDS[name]
+            baseline = _median_run_ms(command + [empty], runs=5)
+            for mode in AliasMode:
+                path = os.path.join(directory, f'{name}.{mode.value}')
+                os.environ['FILE'] = path
+                elapsed = _median_run_ms(command + [path], runs=5)
+                results[f'{name} {mode.value}_ms'] = elapsed
+                aliases = len(shell_set.all_shells[name].aliases)
+                print(f'{name:<8}{mode.value:<12}{aliases:>10}{elapsed:>10.1f}{elapsed - baseline:>12.1f}')
+            results[f'{name} empty_ms'] = baseline
+    record_benchmark(args, 'sourcing', results)
+
+
+# compiles a config full of other key permutations directives with every
+# permutation written out and with a typo table, and compares the size of the
+# outputs and how long sourcing them takes in every installed shell
+def benchmark_typos(args):
+    import tempfile
+    lines = [f'abbr(k{i:02d}wxyz, echo {i}) -> other key permutations' for i in range(40)]
+    shells = [name for name in auto_detect_shells() if name in SOURCE_COMMANDS]
+    if not shells:
+        print('none of the shells this benchmark can source are installed')
+        return
+    results = {}
+    print(f'{"shell":<8}{"strategy":<12}{"bytes":>10}{"ms":>10}')
+    with tempfile.TemporaryDirectory() as directory:
+        for strategy in ('expanded', 'typo table'):
+            engine = PermutationEngine(typo_table=strategy == 'typo table')
+            outputs = compile('\n'.join(lines), shells, engine=engine)
+            for name in shells:
+                path = os.path.join(directory, f'{name}.{strategy}')
+                with open(path, 'w') as file:
+                    file.write(outputs[name])
+                os.environ['FILE'] = path
+                elapsed = _median_run_ms(SOURCE_COMMANDS[name] + [path], runs=5)
+                size = len(outputs[name].encode())
+                results[f'{name} {strategy} bytes'] = size
+                results[f'{name} {strategy} ms'] = elapsed
+                print(f'{name:<8}{strategy:<12}{size:>10}{elapsed:>10.1f}')
+    record_benchmark(args, 'typos', results)
+
+
+BENCHMARKS = {
+    'compile': benchmark_compile,
+    'includes': benchmark_includes,
+    'sourcing': benchmark_sourcing,
+    'jobs': benchmark_jobs,
+    'server': benchmark_server,
+    'startup': benchmark_startup,
+    'suite': benchmark_suite,
+    'typos': benchmark_typos,
+}
 
 
-class TestRunner(unittest.TestCase):
+# test methods only, run_tests mixes this into unittest.TestCase so unittest is
+# only imported when the tests run
+class TestRunner:
+    def _temporary_directory(self):
+        import tempfile
+        return tempfile.TemporaryDirectory()
+
     def test_add_abbr_fish1(self):
         shell = Fish()
         shell.add_abbr("ls", "eza")
@@ -746,38 +3526,932 @@ class TestRunner(unittest.TestCase):
         original = ["hello()", "bye", "# byte", "h#llo", "c\\#llo", ]
         expected = ["hello()", "bye", "h", "c#llo"]
 
-        self.assertEqual(filter_lines_and_handle_sourcing(original), expected)
-
-
-if __name__ == '__main__':
-    # argv[0] is the program itself, even if run directly as an executable
-    args = parse_args(sys.argv[1:])
+        self.assertEqual(
+            list(filter_lines_and_handle_sourcing(original)), expected)
+
+    def test_tokenize_line(self):
+        command = tokenize_line(
+            "alias(gs, git status | less) -> permutate key # comment", "a.conf", 3)
+        self.assertEqual(command.name, "alias")
+        self.assertEqual(command.params, ("gs", "git status | less"))
+        self.assertEqual(command.directives, ("permutate key",))
+        self.assertEqual((command.path, command.line_number), ("a.conf", 3))
+        self.assertEqual(tokenize_line("  # only a comment"), None)
+        self.assertEqual(tokenize_line("set_env(a, b\\#c)").params, ("a", "b#c"))
+
+    def test_process_config_collects_errors_with_locations(self):
+        shell_set = ShellSet({"bash"})
+        lines = ["alias(a,b)", "frog(a)", "alias(a)", "set_shells(elvish)",
+                 "add_path(~/bin)"]
+        errors = process_config(parse_lines(lines, "x.conf"), shell_set)
+        self.assertEqual([(e.path, e.line_number) for e in errors],
+                         [("x.conf", 2), ("x.conf", 3), ("x.conf", 4)])
+        bash = shell_set.all_shells["bash"]
+        self.assertEqual(bash.aliases, {"a": "b"})
+        self.assertEqual(bash.paths_to_add, ["~/bin"])
+
+    def test_directive_errors_stop_preprocessing(self):
+        engine = PermutationEngine(max_permutations=2)
+        commands = preprocess_lines(
+            ["alias(a,b)", "abbr(abc, x) -> permutate key"], engine, "x.conf")
+        errors = process_config(commands, ShellSet({"bash"}))
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0].line_number, 2)
+        self.assertIn("6 permutations", str(errors[0]))
+
+    def test_render_streams_into_text_and_binary_sinks(self):
+        shell = Zsh()
+        shell.motion_mode = MotionMode.VI
+        shell.set_environment_variable("EDITOR", "nvim")
+        shell.add_path("~/bin")
+        shell.add_alias("l", "ls")
+        shell.add_alias("la", "ls -a")
+        expected = ("bindkey -v\n\n#environment variables\nexport EDITOR=nvim\n\n"
+                    "#update path\npath+=~/bin\n\n#aliases\nalias l=ls\nalias la=\"ls -a\"\n\n")
+        self.assertEqual(str(shell), expected)
+        buffer = io.BytesIO()
+        shell.render(buffer)
+        self.assertEqual(buffer.getvalue(), expected.encode())
+
+    def test_print_shell_set(self):
+        shell_set = ShellSet({"bash", "fish"})
+        shell_set.add_alias("l", "ls")
+        buffer = io.StringIO()
+        print_shell_set(shell_set, buffer)
+        expected = "fish:~/.config/fish/easy_env.fish\n#aliases\nalias l ls\n\n\n\nbash:~/.easy_env_bash\n#aliases\nalias l=ls\n"
+        self.assertEqual(buffer.getvalue(), expected)
+
+    def test_template_renders_per_variable_format(self):
+        template = Template("{HOME}/bin:\\{literal\\}")
+        self.assertEqual(Shell().reformat_env_variables(template),
+                         "$HOME/bin:{literal}")
+        self.assertEqual(Nu().reformat_env_variables(template),
+                         "$env.HOME/bin:{literal}")
+        self.assertIs(Shell().reformat_env_variables(template),
+                      Zsh().reformat_env_variables(template))
+
+    def test_fish_alias_is_formatted_once(self):
+        shell = Fish()
+        shell.add_alias("o", "open \\{x\\} {HOME}")
+        self.assertEqual(shell.aliases_string(), "alias o open {x} $HOME")
+
+    def test_identical_sections_are_shared(self):
+        shell_set = ShellSet({"bash", "zsh", "fish"})
+        shell_set.add_alias("l", "ls {HOME}")
+        shell_set.set_targets(["bash"])
+        shell_set.add_path("~/bin")
+        shell_set.set_targets(["bash", "zsh"])
+        shell_set.set_env_variable("A", "b")
+        outputs = {shell.shell_name: str(shell) for shell in shell_set}
+        bash, zsh = shell_set.all_shells["bash"], shell_set.all_shells["zsh"]
+        self.assertEqual(bash.section_key("aliases"), zsh.section_key("aliases"))
+        self.assertEqual(bash.section_key("env_variables"), zsh.section_key("env_variables"))
+        self.assertNotEqual(bash.section_key("paths_to_add"), zsh.section_key("paths_to_add"))
+        self.assertEqual(sorted(shell_set.section_cache.values()),
+                         ['alias l="ls $HOME"', "export A=b"])
+        self.assertEqual(outputs["zsh"], "#environment variables\nexport A=b\n\n#aliases\nalias l=\"ls $HOME\"\n\n")
+        self.assertIn("export PATH", outputs["bash"])
+
+    def test_shared_sections_render_entries_added_later(self):
+        shell_set = ShellSet({"bash", "zsh"})
+        shell_set.add_alias("a", "1")
+        self.assertEqual([str(shell) for shell in shell_set], ["#aliases\nalias a=1\n\n"] * 2)
+        shell_set.add_alias("b", "2")
+        self.assertEqual([str(shell) for shell in shell_set], ["#aliases\nalias a=1\nalias b=2\n\n"] * 2)
+        # a shell changed on its own stops sharing the section
+        shell_set.all_shells["bash"].add_alias("c", "3")
+        self.assertEqual([str(shell) for shell in shell_set],
+                         ["#aliases\nalias a=1\nalias b=2\nalias c=3\n\n", "#aliases\nalias a=1\nalias b=2\n\n"])
+
+    def test_combined_and_guarded_paths(self):
+        shell_set = ShellSet({"bash", "zsh", "fish", "nu"})
+        shell_set.set_path_mode("combined")
+        for path in ["~/bin", "{HOME}/go bin", "~/bin"]:
+            shell_set.add_path(path)
+        outputs = {shell.shell_name: shell.add_paths_string() for shell in shell_set}
+        self.assertEqual(outputs, {
+            "bash": 'export PATH="$PATH:~/bin:$HOME/go bin"',
+            "zsh": 'path+=(~/bin "$HOME/go bin")',
+            "fish": 'fish_add_path ~/bin "$HOME/go bin"',
+            "nu": '$env.path ++= [~/bin, $env.HOME/go bin]',
+        })
+        shell_set.set_path_mode("guarded")
+        self.assertEqual(shell_set.all_shells["bash"].add_paths_string(),
+                         'case ":$PATH:" in *":~/bin:"*) ;; *) PATH="$PATH:~/bin" ;; esac\n'
+                         'case ":$PATH:" in *":$HOME/go bin:"*) ;; *) PATH="$PATH:$HOME/go bin" ;; esac\n'
+                         'export PATH')
+        self.assertEqual(shell_set.all_shells["zsh"].add_paths_string(),
+                         'typeset -U path PATH\npath+=(~/bin "$HOME/go bin")')
+
+    def test_batched_aliases(self):
+        shell_set = ShellSet({"bash", "fish", "nu"})
+        shell_set.set_alias_mode("batched")
+        shell_set.add_alias("la", "ls -a")
+        shell_set.add_alias("q", "echo it's")
+        shell_set.add_abbr("g", "git")
+        bash, fish, nu = (shell_set.all_shells[name] for name in ("bash", "fish", "nu"))
+        self.assertEqual(bash.aliases_string(), "alias la='ls -a' q='echo it'\\''s' g='git'")
+        self.assertEqual(fish.aliases_string(), "function la --wraps 'ls -a'; ls -a $argv; end\n"
+                                                "function q --wraps 'echo it\\'s'; echo it's $argv; end")
+        self.assertEqual(fish.abbrs_string(), "abbr g git")
+        self.assertEqual(nu.aliases_string(), "alias la = ls -a\nalias q = echo it's\nalias g = git")
+        self.assertEqual(list(fish.batched_alias_lines({"ls": "ls --color", "cd": "cd -P", "ll": "'ls -l'"})),
+                         ["function ls; command ls --color $argv; end",
+                          "function cd; builtin cd -P $argv; end",
+                          "function ll --wraps 'ls -l'; ls -l $argv; end"])
+        for i in range(ALIAS_BATCH_SIZE):
+            shell_set.add_alias(f"a{i}", "b")
+        self.assertEqual(len(bash.aliases_string().split("\n")), 2)
+
+    def test_folded_variables(self):
+        shell_set = ShellSet({"bash", "nu"})
+        errors = process_config(parse_lines([
+            "set_variable_mode(folded)",
+            "set_env(C, {B}/c)",
+            "set_env(A, /opt)",
+            "set_env(B, {A}/b \\{x\\})",
+            "set_env(D, {HOME}/d)",
+            "set_env(E, {D}/e)",
+            "set_env(P, {P}:{A})",
+            "alias(go, cd {C})",
+            "add_path({B}/bin)",
+        ]), shell_set)
+        self.assertEqual(errors, [])
+        bash, nu = shell_set.all_shells["bash"], shell_set.all_shells["nu"]
+        self.assertEqual(bash.env_variables, {"A": "/opt", "B": "/opt/b {x}", "C": "/opt/b {x}/c",
+                                              "D": "$HOME/d", "E": "$D/e", "P": "$P:/opt"})
+        self.assertEqual(nu.env_variables["E"], "$env.D/e")
+        self.assertEqual(bash.aliases, {"go": "cd /opt/b {x}/c"})
+        self.assertEqual(bash.paths_to_add, ["/opt/b {x}/bin"])
+        self.assertEqual(shell_set.variable_report(),
+                         "nu: folded 3 of 6 variable(s), left to the shell: HOME\n"
+                         "bash: folded 3 of 6 variable(s), left to the shell: HOME")
+        errors = process_config(parse_lines(["set_env(X, {Y})", "set_env(Y, {X})"]), shell_set)
+        self.assertEqual([str(error) for error in errors],
+                         ["variables reference each other in a cycle: X -> Y -> X"])
+
+    def test_values_are_quoted_from_each_shells_escape_table(self):
+        shell_set = ShellSet({"bash", "fish", "nu"})
+        shell_set.add_alias("say", 'echo "hi" > out')
+        shell_set.add_alias("q", "echo it's")
+        shell_set.add_abbr("s", "echo it's")
+        shell_set.set_env_variable("A", 'a "b"')
+        bash, fish, nu = (shell_set.all_shells[name] for name in ("bash", "fish", "nu"))
+        self.assertEqual(classify('echo "hi" > out'), SPACE | DOUBLE_QUOTE | REDIRECT)
+        self.assertEqual(bash.aliases_string(), 'alias say="echo \\"hi\\" > out"\n'
+                                                'alias q="echo it\'s"\nalias s="echo it\'s"')
+        self.assertEqual(bash.env_variable_string(), 'export A="a \\"b\\""')
+        shell_set.set_env_variable("X", "a | b")
+        shell_set.set_env_variable("Y", "it's")
+        shell_set.set_env_variable("Z", "a b")
+        self.assertEqual(list(fish.env_variable_lines()),
+                         ['set -gx A "a \\"b\\""', 'set -gx X "a | b"', 'set -gx Y "it\'s"', 'set -gx Z a b'])
+        self.assertEqual(list(nu.env_variable_lines()),
+                         ['$env.A = "a \\"b\\""', '$env.X = "a | b"', '$env.Y = "it\'s"', '$env.Z = "a b"'])
+        self.assertEqual(fish.aliases_string(), 'alias say "echo \\"hi\\" > out"\nalias q "echo it\'s"')
+        self.assertEqual(fish.abbrs_string(), "abbr s 'echo it\\'s'")
+        self.assertEqual(nu.aliases_string(), 'def say [...args] {echo "hi" > out ...$args}\n'
+                                              "alias q = echo it's\nalias s = echo it's")
+
+    def test_values_already_in_quotes_are_not_quoted_again(self):
+        shell_set = ShellSet({"bash", "fish"})
+        shell_set.add_alias("la", '"ls -a"')
+        shell_set.add_alias("ll", "'ls -l'")
+        shell_set.set_env_variable("A", '"a b"')
+        bash, fish = shell_set.all_shells["bash"], shell_set.all_shells["fish"]
+        self.assertEqual(bash.aliases_string(), 'alias la="ls -a"\nalias ll=\'ls -l\'')
+        self.assertEqual(bash.env_variable_string(), 'export A="a b"')
+        self.assertEqual(fish.aliases_string(), 'alias la "ls -a"\nalias ll \'ls -l\'')
+        shell_set.set_alias_mode("batched")
+        self.assertEqual(bash.aliases_string(), 'alias la="ls -a" ll=\'ls -l\'')
+        # a value that only starts with a quote is still quoted
+        self.assertEqual(POSIX_ESCAPES.quote("alias", '"a" b'), '"\\"a\\" b"')
+
+    def test_environment_and_interactive_outputs(self):
+        shell_set = ShellSet({"bash", "zsh"})
+        shell_set.set_motion_mode("vi")
+        shell_set.set_env_variable("A", "b")
+        shell_set.add_alias("l", "ls")
+        shell_set.set_compile_env_path("bash", "~/.easy_env_bash_env")
+        self.assertEqual([(name, path) for name, path, _ in _shell_outputs(shell_set)],
+                         [("bash environment", "~/.easy_env_bash_env"),
+                          ("bash interactive", "~/.easy_env_bash"),
+                          ("zsh", "~/.easy_env_zsh")])
+        bash = shell_set.all_shells["bash"]
+        self.assertEqual(_render_to_string(bash.render_environment), "#environment variables\nexport A=b\n\n")
+        self.assertEqual(_render_to_string(bash.render_interactive),
+                         "[[ $- == *i* ]] || return 0\n\nset -o vi\n\n#aliases\nalias l=ls\n\n")
+
+    def test_commands_are_stored_once_for_all_shells(self):
+        shell_set = ShellSet({"bash", "fish"})
+        shell_set.add_abbr(" la ", "ls -a ")
+        shell_set.add_alias("l", "ls {HOME}")
+        shell_set.set_targets(["fish"])
+        shell_set.add_alias("l", "eza")
+        self.assertEqual(len(shell_set.entries.rows["alias"]), 3)
+        bash, fish = shell_set.all_shells["bash"], shell_set.all_shells["fish"]
+        self.assertEqual(bash.aliases, {" la ": "ls -a ", "l": "ls $HOME"})
+        self.assertEqual(fish.aliases, {"l": "eza"})
+        self.assertEqual(fish.abbrs, {"la": "ls -a"})
+        self.assertEqual(bash.abbrs, {})
+        self.assertEqual([shell.shell_name for shell in shell_set], ["fish", "bash"])
+        self.assertNotIn("zsh", shell_set.all_shells)
+
+    def test_parallel_write_matches_sequential(self):
+        with self._temporary_directory() as directory:
+            outputs = []
+            for jobs in (1, 4):
+                output_dir = os.path.join(directory, str(jobs))
+                shell_set = ShellSet()
+                process_config(parse_lines(synthetic_config(
+                    aliases=50, output_dir=output_dir)), shell_set)
+                written = write_shell_set(shell_set, OutputWriter(
+                    FsyncMode.NEVER), jobs)
+                outputs.append([(os.path.basename(path), digest)
+                               for path, digest in written.items()])
+            self.assertEqual(outputs[0], outputs[1])
+
+    def test_parallel_write_aggregates_errors(self):
+        with self._temporary_directory() as directory:
+            shell_set = ShellSet({"bash", "zsh", "fish"})
+            for name in ["bash", "zsh", "fish"]:
+                shell_set.set_compile_path(name, os.path.join(directory, name))
+            os.makedirs(os.path.join(directory, "bash"))
+            os.makedirs(os.path.join(directory, "fish"))
+            shell_set.add_alias("l", "ls")
+            with self.assertRaises(OutputError) as context:
+                write_shell_set(shell_set, OutputWriter(FsyncMode.NEVER), jobs=3)
+            self.assertEqual(len(context.exception.errors), 2)
+            self.assertEqual(sorted(os.listdir(directory)), ["bash", "fish"])
+
+    def _make_executable(self, directory, name):
+        path = self._write_config(directory, name, '#!/bin/sh\n')
+        os.chmod(path, 0o755)
+
+    def test_auto_detect_shells_scans_path_once_and_caches(self):
+        with self._temporary_directory() as directory:
+            first = os.path.join(directory, 'first')
+            second = os.path.join(directory, 'second')
+            os.makedirs(first)
+            os.makedirs(second)
+            self._make_executable(first, 'fish')
+            self._make_executable(second, 'xonsh')
+            self._write_config(second, 'zsh', 'not executable')
+            search_path = os.pathsep.join([first, second, first])
+            cache_path = os.path.join(directory, 'cache', 'shells.json')
+
+            self.assertEqual(auto_detect_shells(
+                search_path, cache_path), ['fish', 'xonsh'])
+            with open(cache_path) as file:
+                self.assertEqual(json.load(file)['shells'], ['fish', 'xonsh'])
+
+            self._make_executable(second, 'bash')
+            os.utime(second, ns=(0, 1))
+            self.assertEqual(auto_detect_shells(
+                search_path, cache_path), ['bash', 'fish', 'xonsh'])
+
+    def test_launcher_imports_the_program(self):
+        import subprocess
+        launcher = os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'easy_env_config.py')
+        result = subprocess.run([sys.executable, launcher, '-v'],
+                                capture_output=True, text=True)
+        self.assertEqual(result.stdout.strip(), CURRENT_VERSION)
+        result = subprocess.run([sys.executable, '-c', 'import sys, easy_env_config; '
+                                 'print(easy_env_config.CURRENT_VERSION, "unittest" in sys.modules)'],
+                                capture_output=True, text=True, cwd=os.path.dirname(launcher))
+        self.assertEqual(result.stdout.strip(), f'{CURRENT_VERSION} False')
+
+    def test_shells_are_created_when_targeted(self):
+        shell_set = ShellSet({"bash"})
+        self.assertEqual(list(shell_set.all_shells), ["bash"])
+        process_config(parse_lines(["compile_path(fish, ~/f.fish)", "set_shells(zsh)",
+                                    "alias(l, ls)"]), shell_set)
+        self.assertEqual(sorted(shell_set.all_shells), ["bash", "fish", "zsh"])
+        self.assertEqual([shell.shell_name for shell in shell_set], ["zsh"])
+
+    def test_plugins_register_shells(self):
+        with self._temporary_directory() as directory:
+            self._write_config(directory, "ion.py", "\n".join([
+                "def register(easy_env):",
+                "    class Ion(easy_env.Shell):",
+                "        @property",
+                "        def shell_name(self):",
+                "            return 'ion'",
+                "    easy_env.register_shell('ion', Ion, 'ion-shell')",
+            ]))
+            self._write_config(directory, "notes.txt", "not a plugin")
+            try:
+                self.assertEqual(load_plugins(directory), ["ion"])
+                self.assertEqual(shell_to_command["ion"], "ion-shell")
+                self.assertEqual(compile("alias(l, ls)", ["ion"]), {"ion": "#aliases\nalias l=ls\n\n"})
+            finally:
+                SHELLS.pop("ion", None)
+                shell_to_command.pop("ion", None)
+        self.assertEqual(load_plugins(os.path.join(directory, "missing")), [])
+
+    def test_synthetic_tree_scenarios_compile(self):
+        with self._temporary_directory() as directory:
+            for scenario, size in [('deep', {'aliases': 30, 'depth': 3}),
+                                   ('wide', {'aliases': 30, 'width': 3}),
+                                   ('permutations', {'permutation_keys': 2}),
+                                   ('variables', {'variable_values': 5})]:
+                scenario_dir = os.path.join(directory, scenario)
+                os.makedirs(os.path.join(scenario_dir, 'out'))
+                root = write_synthetic_tree(scenario_dir, **size)
+                timings = benchmark_scenario(
+                    root, os.path.join(scenario_dir, 'out'), repeat=1)
+                self.assertIn('render_bash', timings)
+                self.assertIn('write_shell_set', timings)
+
+    def test_compare_to_baseline(self):
+        baseline = {'a': {'parse': 0.100, 'render': 0.001}}
+        results = {'a': {'parse': 0.200, 'render': 0.002, 'new': 1.0}}
+        regressions = compare_to_baseline(results, baseline, 0.25)
+        self.assertEqual(len(regressions), 1)
+        self.assertTrue(regressions[0].startswith('a parse'))
+        # within three times the measured spread of the stage it is noise
+        spreads = {'a': {'parse': 0.040}}
+        self.assertEqual(compare_to_baseline(results, baseline, 0.25, spreads=spreads), [])
+
+    def test_timings_exclude_the_stages_they_pull_from(self):
+        timings = Timings()
+
+        def slow_lines():
+            for line in ["alias(a,b)", "abbr(ab, x) -> permutate key"]:
+                time.sleep(0.01)
+                yield line
+        lines = timings.iterate('reading', slow_lines())
+        commands = timings.iterate_file('root.conf', timings.iterate(
+            'parsing', parse_lines(lines, 'root.conf')))
+        with timings.stage('execution'):
+            self.assertEqual(len(list(expand_directives(commands))), 3)
+        report = timings.to_json()
+        self.assertGreaterEqual(report['stages']['reading']['wall_ms'], 20)
+        self.assertLess(report['stages']['execution']['wall_ms'], 10)
+        self.assertGreaterEqual(report['files']['root.conf']['wall_ms'], 20)
+
+    def test_timings_flag_keeps_the_config_file(self):
+        args = parse_args(['--timings', os.devnull])
+        self.assertTrue(args.timings)
+        self.assertEqual(args.file.name, os.devnull)
+        args.file.close()
+        self.assertEqual(parse_args(['--timings-format', 'json']).timings_format, 'json')
+
+    def test_disabled_timings_add_nothing(self):
+        lines = iter(["alias(a,b)"])
+        self.assertIs(DisabledTimings().iterate('reading', lines), lines)
+        self.assertIs(TIMINGS.iterate('reading', lines), lines)
+
+    def test_missing_sourced_file_is_a_config_error(self):
+        errors = process_config(handle_sourcing(parse_lines(
+            ["source(/does/not/exist.conf)"], "root.conf")), ShellSet({"bash"}))
+        self.assertEqual(len(errors), 1)
+        self.assertEqual((errors[0].path, errors[0].line_number), ("root.conf", 1))
+
+    def _source(self, root, references=None):
+        graph = IncludeGraph(root, references=references)
+        commands = handle_sourcing(preprocess_lines(
+            iter_file_lines(root), path=root), os.path.dirname(root), graph=graph)
+        return [str(command) for command in commands], graph
+
+    def test_shared_includes_are_preprocessed_once(self):
+        with self._temporary_directory() as directory:
+            os.mkdir(os.path.join(directory, 'sub'))
+            self._write_config(directory, 'shared.conf', 'add_path(~/bin)')
+            self._write_config(directory, 'sub/a.conf', 'source(../shared.conf)')
+            root = self._write_config(
+                directory, 'root.conf', 'source(sub/a.conf, shared.conf)\nsource_once(shared.conf)')
+            references = {}
+            prefetch_includes(root, workers=2, references=references)
+            self.assertEqual(sorted((os.path.basename(path), count) for path, count in references.items()),
+                             [('a.conf', 1), ('shared.conf', 3)])
+            commands, graph = self._source(root, references)
+            self.assertEqual(commands, ['add_path(~/bin)', 'add_path(~/bin)'])
+            self.assertEqual((len(graph.sourced), graph.references, graph.reused, graph.skipped, graph.max_depth),
+                             (2, 4, 1, 1, 2))
+            # the last reference was skipped, so the memo is still there
+            self.assertEqual(len(graph.commands), 1)
+
+    def test_includes_sourced_once_are_streamed(self):
+        with self._temporary_directory() as directory:
+            self._write_config(directory, 'once.conf', 'alias(a,b)')
+            self._write_config(directory, 'twice.conf', 'alias(c,d)')
+            root = self._write_config(directory, 'root.conf', 'source(once.conf, twice.conf, twice.conf)')
+            references = {}
+            prefetch_includes(root, workers=2, references=references)
+            commands, graph = self._source(root, references)
+            self.assertEqual(commands, ['alias(a, b)', 'alias(c, d)', 'alias(c, d)'])
+            # twice.conf was dropped after its last reference and once.conf never kept
+            self.assertEqual((graph.reused, graph.commands), (1, {}))
+            # without reference counts a file is kept from its second reference on
+            commands, graph = self._source(root)
+            self.assertEqual(commands, ['alias(a, b)', 'alias(c, d)', 'alias(c, d)'])
+            self.assertEqual((graph.reused, [os.path.basename(path) for path, _ in graph.commands]),
+                             (0, ['twice.conf']))
+
+    def test_prefetched_includes_preprocess_the_same(self):
+        with self._temporary_directory() as directory:
+            root = write_synthetic_tree(directory, aliases=40, depth=2, width=2)
+            self._write_config(directory, 'level2.conf', 'alias(x,y)\n# source(missing.conf)')
+            prefetched = prefetch_includes(root, workers=2)
+            self.assertEqual(sorted(os.path.basename(path) for path in prefetched),
+                             ['level1.conf', 'level2.conf', 'root.conf'])
+            self.assertEqual(_preprocess_tree(root, 2, read_bytes),
+                             _preprocess_tree(root, 0, read_bytes))
+            # every file is released once it was preprocessed
+            graph = IncludeGraph(root, prefetched)
+            mtime, data = graph.fetch(root, graph.chain[0])
+            for _ in handle_sourcing(preprocess_lines(iter_data_lines(data), path=root),
+                                     directory, graph=graph):
+                self.assertLess(len(graph.prefetched), 3)
+            self.assertEqual(graph.prefetched, {})
+
+    def test_compile_in_memory(self):
+        files = {"sub/a.conf": "alias(a, b)\nsource(../b.conf)", "b.conf": "set_env(B, {HOME})"}
+        outputs = compile("set_shells(bash, nu)\nsource(sub/a.conf)", shells={"bash", "fish"}, files=files)
+        self.assertEqual(outputs, {"nu": '#environment variables\n$env.B = "$env.HOME"\n\n#aliases\nalias a = b\n\n',
+                                   "bash": "#environment variables\nexport B=$HOME\n\n#aliases\nalias a=b\n\n"})
+        with self.assertRaises(CompileError) as context:
+            compile("frog(a)\nalias(a)", path="service.conf")
+        self.assertEqual([(error.path, error.line_number) for error in context.exception.errors],
+                         [("service.conf", 1), ("service.conf", 2)])
+
+    def test_compile_server_caches_by_resolved_content(self):
+        import asyncio
+        server = CompileServer(cache_size=2)
+        bundle = {"config": "source(a.conf)", "files": {"a.conf": "alias(a, b)"}, "shells": ["bash"]}
+
+        def post(bundle):
+            return asyncio.run(server.respond("POST", "/compile", json.dumps(bundle).encode()))
+
+        self.assertEqual(post(bundle), (200, {"outputs": {"bash": "#aliases\nalias a=b\n\n"}}))
+        # files the config doesn't source don't change the key
+        self.assertEqual(post({**bundle, "files": {**bundle["files"], "b.conf": "x"}})[0], 200)
+        self.assertEqual(post({"config": "frog()"})[0], 422)
+        self.assertEqual(post({"shells": []})[0], 400)
+        metrics = server.metrics.to_json()
+        self.assertEqual((metrics["requests"], metrics["hits"], metrics["errors"]), (4, 1, 2))
+        for i in range(3):
+            post({"config": f"alias(a{i}, b)"})
+        self.assertEqual(len(server.cache), 2)
+
+    def test_compile_server_limits_requests_and_keeps_other_files(self):
+        import asyncio
+        server = CompileServer(max_request_size=64)
+        with self._temporary_directory() as directory:
+            address = self._write_config(directory, 'not-a-socket', 'alias(a,b)')
+            with self.assertRaises(OSError):
+                asyncio.run(server.serve(address))
+            with open(address) as file:
+                self.assertEqual(file.read(), 'alias(a,b)')
+            address = os.path.join(directory, 'server.sock')
+
+            async def requests():
+                ready = asyncio.Event()
+                task = asyncio.create_task(server.serve(address, ready.set))
+                await ready.wait()
+                reader, writer = await asyncio.open_unix_connection(address)
+                body = json.dumps({"config": "alias(a, b)", "shells": ["bash"]}).encode()
+                small = await _http_request(reader, writer, 'POST', '/compile', body)
+                large = await _http_request(reader, writer, 'POST', '/compile', b' ' * 65)
+                closed = await reader.read()
+                writer.close()
+                task.cancel()
+                return small[0], large, closed
+
+            self.assertEqual(asyncio.run(requests()),
+                             (200, (413, {'error': 'request body larger than 64 bytes'}), b''))
+            # the socket of the earlier server is replaced
+
+            async def restart():
+                ready = asyncio.Event()
+                task = asyncio.create_task(server.serve(address, ready.set))
+                await ready.wait()
+                task.cancel()
+            asyncio.run(restart())
+
+    def test_compile_from_many_threads(self):
+        from concurrent.futures import ThreadPoolExecutor
+        configs = ["\n".join(synthetic_config(aliases=i * 10, env_variables=i, paths=i)) for i in range(8)]
+        expected = [compile(config) for config in configs]
+        with ThreadPoolExecutor(4) as executor:
+            self.assertEqual(list(executor.map(compile, configs * 4)), expected * 4)
+
+    def test_source_cycles_are_reported(self):
+        with self._temporary_directory() as directory:
+            a = self._write_config(directory, 'a.conf', 'source(b.conf)')
+            b = self._write_config(directory, 'b.conf', 'alias(a,b)\nsource(a.conf)')
+            with self.assertRaises(ConfigError) as context:
+                self._source(a)
+            self.assertEqual((context.exception.path, context.exception.line_number), (b, 2))
+            self.assertIn(f'source cycle: {os.path.realpath(a)} -> {os.path.realpath(b)} -> {os.path.realpath(a)}',
+                          str(context.exception))
+
+    def _check_watcher(self, watcher):
+        with self._temporary_directory() as directory:
+            watched = self._write_config(directory, 'watched.conf', 'alias(a,b)')
+            self._write_config(directory, 'other.conf', 'alias(a,b)')
+            watcher.set_files([watched])
+            self.assertEqual(watcher.wait(0.05), set())
+            self._write_config(directory, 'other.conf', 'alias(c,d)')
+            self.assertEqual(watcher.wait(0.05), set())
+            # editors often save by renaming a new file over the old one
+            replacement = self._write_config(directory, 'new.tmp', 'alias(e,f)')
+            os.replace(replacement, watched)
+            self.assertEqual(watcher.wait(1), {os.path.realpath(watched)})
+            watcher.close()
+
+    def test_watched_print_builds_reread_the_config(self):
+        import contextlib
+        with self._temporary_directory() as directory:
+            root = self._write_config(directory, 'root.conf', 'alias(a,b)\nsource(inc.conf)\n')
+            self._write_config(directory, 'inc.conf', 'alias(c,d)\n')
+            args = parse_args(['-p', root])
+            for _ in range(2):
+                watched = set()
+                output = io.StringIO()
+                with contextlib.redirect_stdout(output):
+                    self.assertEqual(build(args, watched), 0)
+                self.assertIn('alias a=b\nalias c=d', output.getvalue())
+                self.assertEqual(watched, {root, os.path.join(directory, 'inc.conf')})
+            args.file.close()
+
+    def test_inotify_watcher(self):
+        if not sys.platform.startswith('linux'):
+            self.skipTest('inotify is only available on linux')
+        self._check_watcher(InotifyWatcher())
+
+    def test_polling_watcher(self):
+        self._check_watcher(PollingWatcher(interval=0.01))
+
+    def test_filter_lines_is_lazy(self):
+        def endless_config():
+            while True:
+                yield "alias(a,b) # comment"
+        filtered = filter_lines_and_handle_sourcing(endless_config())
+        self.assertEqual(next(filtered), "alias(a, b)")
+        self.assertEqual(next(filtered), "alias(a, b)")
+
+    def test_permutations_are_unique_and_sorted(self):
+        engine = PermutationEngine()
+        self.assertEqual(list(engine.permutations("sh0")), [
+                         "0hs", "0sh", "h0s", "hs0", "s0h", "sh0"])
+        self.assertEqual(list(engine.permutations("aab")),
+                         ["aab", "aba", "baa"])
+        self.assertEqual(engine.count("aabbcc"), 90)
+        self.assertEqual(len(list(engine.permutations("aabbcc"))), 90)
+
+    def test_permutation_limits_fail_before_generating(self):
+        engine = PermutationEngine(max_key_length=4, max_permutations=10)
+        with self.assertRaises(PermutationLimitError):
+            engine.permutations("abcde")
+        with self.assertRaisesRegex(PermutationLimitError, "24 permutations"):
+            engine.permutations("abcd")
+        self.assertEqual(len(list(engine.permutations("aabb"))), 6)
+        # the count of a long key has too many digits to print
+        with self.assertRaises(CompileError) as context:
+            compile(f"alias({'ab' * 1000}, x) -> permutate key")
+        self.assertIn("2000 characters long", str(context.exception))
+
+    def test_other_key_permutations_directive(self):
+        lines = list(filter_lines_and_handle_sourcing(
+            ["abbr(git, git) -> other key permutations"]))
+        self.assertEqual(lines, ["abbr(gti, git)", "abbr(igt, git)", "abbr(itg, git)",
+                                 "abbr(tgi, git)", "abbr(tig, git)"])
+
+    def test_typo_table(self):
+        engine = PermutationEngine(typo_table=True)
+        config = "abbr(git, git) -> other key permutations\nalias(ab, echo it's) -> permutate key"
+        self.assertEqual([str(command) for command in preprocess_lines(config.split("\n"), engine)],
+                         ["(typo table)(abbr, git, git, other key permutations)",
+                          "(typo table)(alias, ab, echo it's, permutate key)"])
+        outputs = compile(config, ["bash", "fish", "nu"], engine=engine)
+        self.assertIn("alias ab=\"echo it's\"\n\n#typo corrections\n"
+                      "if ! typeset -f _easy_env_previous_command_not_found_handle >/dev/null", outputs["bash"])
+        self.assertIn("        'git') [ \"$1\" != 'git' ] && { shift; eval 'git \"$@\"'; return; } ;;\n"
+                      "        'ab') [ \"$1\" != 'ab' ] && { shift; eval 'echo it'\\''s \"$@\"'; return; } ;;\n",
+                      outputs["bash"])
+        self.assertIn("        case 'git'\n            if not contains -- $argv[1] 'git'\n"
+                      "                eval 'git' (string escape -- $argv[2..])\n", outputs["fish"])
+        self.assertNotIn("alias gti", outputs["bash"])
+        self.assertEqual(outputs["nu"], compile(config, ["nu"])["nu"])
+        self.assertNotEqual(engine.key(), DEFAULT_PERMUTATION_ENGINE.key())
+        # configs can't call the command directives are turned into
+        with self.assertRaises(CompileError):
+            compile("typo_table(alias, ls, rm -rf ~, permutate key)")
+
+    def test_typo_table_expands_keys_that_change_the_shell_for_bash(self):
+        engine = PermutationEngine(typo_table=True)
+        config = "alias(gotmp, cd /tmp) -> permutate key\nalias(lsa, ls -a) -> permutate key"
+        outputs = compile(config, ["bash", "fish"], engine=engine)
+        # bash runs the hook in a subshell, where cd would do nothing
+        self.assertIn("alias tmpgo=\"cd /tmp\"", outputs["bash"])
+        self.assertNotIn("'gmopt')", outputs["bash"])
+        self.assertIn("'als')", outputs["bash"])
+        self.assertIn("case 'gmopt'", outputs["fish"])
+        self.assertEqual([changes_shell_state(value) for value in ["cd /tmp", "ls && cd -", "export A=b",
+                                                                   "ls -a", "echo cd"]],
+                         [True, True, True, False, False])
+
+    def test_typo_table_keeps_keys_with_the_same_letters(self):
+        import shutil
+        import subprocess
+        if shutil.which('bash') is None:
+            self.skipTest('bash is not installed')
+        engine = PermutationEngine(typo_table=True)
+        config = "alias(abc, echo 1) -> permutate key\nalias(cab, echo 2) -> permutate key"
+        bash = compile(config, ["bash"], engine=engine)["bash"]
+        self.assertIn("        'abc') [ \"$1\" != 'abc' ] && [ \"$1\" != 'cab' ] && "
+                      "{ shift; eval 'echo 2 \"$@\"'; return; } ;;\n", bash)
+        with self._temporary_directory() as directory:
+            path = self._write_config(directory, 'easy_env', bash)
+            script = ('command_not_found_handle() { echo "earlier $1"; }\n'
+                      f'source {path}\nsource {path}\nbca x\nabc x\nzzz x\n')
+            result = subprocess.run(['bash', '-c', script], capture_output=True, text=True)
+        # abc is a key of its own, so the earlier handler gets it like any unknown command
+        self.assertEqual(result.stdout, "2 x\nearlier abc\nearlier zzz\n")
+
+    def _write_config(self, directory, name, content):
+        path = os.path.join(directory, name)
+        with open(path, 'w') as file:
+            file.write(content)
+        return path
+
+    def test_build_cache_reuses_unchanged_files(self):
+        with self._temporary_directory() as directory:
+            root = self._write_config(
+                directory, 'root.conf', 'alias(a,b)\nsource(inc.conf)\n')
+            inc = self._write_config(directory, 'inc.conf', 'alias(c,d)\n')
+            cache_dir = os.path.join(directory, 'cache')
+
+            cache = BuildCache(root, cache_dir)
+            lines = [str(command) for command in handle_sourcing(
+                cache.preprocess_file(root), directory, cache, root)]
+            self.assertEqual(lines, ['alias(a, b)', 'alias(c, d)'])
+            self.assertEqual(cache.includes, {root: [inc]})
+            cache.save(['bash'], {})
+
+            self._write_config(directory, 'inc.conf', 'alias(e,f)\n')
+            cache = BuildCache(root, cache_dir)
+            commands = list(handle_sourcing(
+                cache.preprocess_file(root), directory, cache, root))
+            self.assertEqual([str(command) for command in commands],
+                             ['alias(a, b)', 'alias(e, f)'])
+            self.assertEqual((commands[1].path, commands[1].line_number), (inc, 1))
+            self.assertEqual(cache.reused, [root])
+            self.assertEqual(cache.rebuilt, [inc])
+
+    def test_build_cache_up_to_date(self):
+        with self._temporary_directory() as directory:
+            root = self._write_config(directory, 'root.conf', 'alias(a,b)\n')
+            output = self._write_config(directory, 'out', 'alias a=b')
+            cache_dir = os.path.join(directory, 'cache')
+
+            cache = BuildCache(root, cache_dir)
+            self.assertFalse(cache.up_to_date(['bash']))
+            cache.preprocess_file(root)
+            cache.save(['bash'], {output: digest_file(output)})
+
+            cache = BuildCache(root, cache_dir)
+            self.assertTrue(cache.up_to_date(['bash']))
+            self.assertFalse(cache.up_to_date(['bash', 'fish']))
+
+            # a new version of the program or a plugin rebuilds
+            LOADED_PLUGINS.append(root)
+            try:
+                self.assertFalse(BuildCache(root, cache_dir).up_to_date(['bash']))
+            finally:
+                LOADED_PLUGINS.remove(root)
+
+            self._write_config(directory, 'out', 'edited by hand')
+            self.assertFalse(cache.up_to_date(['bash']))
+
+    def test_print_writes_nothing(self):
+        import subprocess
+        with self._temporary_directory() as directory:
+            root = self._write_config(directory, 'root.conf', 'alias(a,b)\n')
+            cache_dir = os.path.join(directory, 'cache')
+            result = subprocess.run([sys.executable, os.path.realpath(__file__), '-p', root],
+                                    capture_output=True, text=True,
+                                    env={**os.environ, 'XDG_CACHE_HOME': cache_dir})
+            self.assertIn('alias a=b', result.stdout)
+            self.assertFalse(os.path.exists(cache_dir))
+
+    def test_output_writer_skips_unchanged(self):
+        with self._temporary_directory() as directory:
+            path = self._write_config(directory, 'out', 'alias a=b')
+            mtime = os.stat(path).st_mtime_ns
+            writer = OutputWriter(FsyncMode.NEVER)
+            writer.write(path, 'alias a=b')
+            writer.commit()
+            self.assertEqual(writer.skipped, [path])
+            self.assertEqual(writer.written, [])
+            self.assertEqual(os.stat(path).st_mtime_ns, mtime)
+
+    def test_output_writer_writes_through_symlinks(self):
+        with self._temporary_directory() as directory:
+            target = self._write_config(directory, 'dotfile', 'alias a=b')
+            link = os.path.join(directory, 'link')
+            os.symlink(target, link)
+            for fsync in (FsyncMode.BATCH, FsyncMode.EACH):
+                writer = OutputWriter(fsync)
+                writer.write(link, f'alias a={fsync.value}')
+                writer.commit()
+                self.assertTrue(os.path.islink(link))
+                with open(target) as file:
+                    self.assertEqual(file.read(), f'alias a={fsync.value}')
+
+    def test_output_writer_batch_replaces_atomically(self):
+        with self._temporary_directory() as directory:
+            old = self._write_config(directory, 'old', 'alias a=b')
+            new = os.path.join(directory, 'new')
+            writer = OutputWriter(FsyncMode.BATCH)
+            writer.write(old, 'alias a=c')
+            writer.write(new, 'alias x=y')
+            self.assertEqual(read_file(old), ['alias a=b'])
+            self.assertFalse(os.path.exists(new))
+            writer.commit()
+            self.assertEqual(read_file(old), ['alias a=c'])
+            self.assertEqual(read_file(new), ['alias x=y'])
+            self.assertEqual(sorted(os.listdir(directory)), ['new', 'old'])
+
+    def test_output_writer_streams_changes(self):
+        with self._temporary_directory() as directory:
+            path = self._write_config(directory, 'out', 'abcdef')
+            for content in ['abcxyz', 'abc', 'abcxyz123', '']:
+                writer = OutputWriter(FsyncMode.NEVER)
+                writer.render(path, lambda sink: [sink.write(c) for c in content])
+                self.assertEqual(writer.written, [path])
+                self.assertEqual(read_file(path), [content] if content else [])
+                self.assertEqual(writer.outputs[path], digest_file(path))
+
+
+def run_tests():
+    import unittest
+    test_case = type('TestRunner', (TestRunner, unittest.TestCase), {})
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(test_case)
+    result = unittest.TextTestRunner().run(suite)
+    exit(0 if result.wasSuccessful() else 1)
+
+
+def main(argv):
+    # the version is printed before argparse is even imported
+    if argv in (['-v'], ['--version']):
+        print(CURRENT_VERSION)
+        exit(0)
+    args = parse_args(argv)
     display_version = args.version
     run_test = args.run_test
     if display_version:
         print(CURRENT_VERSION)
         exit(0)
     elif run_test:
-        base_name = sys.argv[0]
-        unittest.main(argv=[
-            base_name])  # needs basename, but if I don't explicitly pass argv it will try to parse all args passed to program
-        # running the test automatically exits the program
+        run_tests()
+        return
+    load_plugins(args.plugin_dir)
+    if args.benchmark:
+        BENCHMARKS[args.benchmark](args)
+    elif args.serve:
+        serve(args)
     else:
-        shells = auto_detect_shells()
-        shell_set = ShellSet(shells)
-        default_config_path = os.path.expanduser(
-            "~/.config/easy_env/easy.conf")
+        run_instrumented(args)
+
+
+# --timings, --trace-memory and --profile wrap the whole run so the report is
+# also printed when the run exits early
+def run_instrumented(args):
+    global TIMINGS
+    profile = None
+    if args.timings or args.trace_memory:
+        TIMINGS = Timings()
+    if args.trace_memory:
+        import tracemalloc
+        tracemalloc.start()
+    if args.profile:
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+    try:
+        run(args)
+    finally:
+        if profile is not None:
+            profile.disable()
+            profile.dump_stats(args.profile)
+        if args.trace_memory:
+            TIMINGS.peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        if TIMINGS.enabled:
+            if args.timings_format == 'json':
+                print(json.dumps(TIMINGS.to_json(), indent=2), file=sys.stderr)
+            else:
+                print(TIMINGS.report(), file=sys.stderr)
+        TIMINGS = DisabledTimings()
 
-        if args.file is None:
-            path = default_config_path
-            unfiltered_lines = read_file(default_config_path)
-        else:
-            path = os.path.abspath(args.file.name)
-            unfiltered_lines = args.file.readlines()
-        parent_dir = os.path.dirname(path)
-        lines = filter_lines_and_handle_sourcing(unfiltered_lines, parent_dir)
-        process_config(lines, shell_set)
-        if args.print:
-            print_shell_set(shell_set)
+
+def run(args):
+    if args.watch:
+        watch(args)
+    else:
+        exit(build(args))
+
+
+# one full run, returns the exit status. the files the config was built from
+# are added to watched when it is given
+def build(args, watched=None) -> int:
+    # printing doesn't write anything to disk, the caches included
+    use_cache = not (args.no_cache or args.print)
+    with TIMINGS.stage('detection'):
+        shells = auto_detect_shells(cache_path=os.path.join(
+            default_cache_dir(), 'shells.json') if use_cache else None)
+    shell_set = ShellSet(shells)
+    default_config_path = os.path.expanduser(
+        "~/.config/easy_env/easy.conf")
+
+    if args.file is None:
+        path = default_config_path
+    else:
+        path = os.path.abspath(args.file.name)
+    parent_dir = os.path.dirname(path)
+    if watched is not None:
+        watched.add(path)
+
+    engine = PermutationEngine(
+        args.max_permutation_key_length, args.max_permutations, args.typo_table)
+    cache = None
+    if use_cache and os.path.isfile(path):
+        with TIMINGS.stage('cache check'):
+            cache = BuildCache(path, engine=engine)
+            up_to_date = cache.up_to_date(shells)
+        if up_to_date:
+            if watched is not None:
+                watched.update(cache.manifest['files'])
+            if args.verbose:
+                manifest = cache.manifest
+                print(f'up to date, skipped {len(manifest["files"])} file(s) '
+                      f'and {len(manifest["outputs"])} output(s)')
+            return 0
+
+    prefetched = {}
+    references = None
+    if args.prefetch > 0 and os.path.isfile(path):
+        references = {}
+        with TIMINGS.stage('prefetch'):
+            prefetched = prefetch_includes(path, args.prefetch, references=references)
+    graph = IncludeGraph(path, prefetched, references=references)
+    root = graph.prefetched.pop(graph.chain[0], None)
+    data = None if root is None else root[1]
+    if cache is not None:
+        commands = handle_sourcing(cache.preprocess_file(
+            path, data), parent_dir, cache, path, engine, graph)
+    else:
+        if data is not None:
+            unfiltered_lines = iter_data_lines(data)
+        elif args.file is None or watched is not None:
+            # the file given on the command line was read by the first build
+            unfiltered_lines = iter_file_lines(path)
         else:
-            write_shell_set(shell_set)
+            unfiltered_lines = args.file
+        commands = handle_sourcing(preprocess_lines(
+            unfiltered_lines, engine, path), parent_dir, engine=engine, graph=graph)
+    commands = TIMINGS.iterate_file(path, commands)
+    try:
+        errors = process_config(commands, shell_set)
+    finally:
+        # missing sourced files are watched too, so creating one rebuilds
+        if watched is not None and cache is not None:
+            watched.update(cache.files)
+            for includes in cache.includes.values():
+                watched.update(includes)
+        elif watched is not None:
+            watched.update(graph.paths)
+    if errors:
+        for error in errors:
+            print(error, file=sys.stderr)
+        return 1
+    if args.print:
+        print_shell_set(shell_set, jobs=args.jobs)
+    else:
+        writer = OutputWriter(args.fsync)
+        try:
+            outputs = write_shell_set(
+                shell_set, writer, args.jobs)
+        except OutputError as e:
+            print(e, file=sys.stderr)
+            return 1
+        if cache is not None:
+            with TIMINGS.stage('cache save'):
+                cache.save(shells, outputs)
+        if args.verbose:
+            print(graph.report())
+            if shell_set.variable_report():
+                print(shell_set.variable_report())
+            if cache is not None:
+                print(cache.report())
+            print(writer.report())
+    return 0
+
+
+if __name__ == '__main__':
+    # argv[0] is the program itself, even if run directly as an executable
+    main(sys.argv[1:])
@@ -0,0 +1,27 @@
+#!/bin/python
+# thin launcher for easy-env-config.py, loading the program as a module lets
+# python cache its compiled bytecode in __pycache__ instead of compiling the
+# whole file again on every run like it does for a script.
+# ./easy_env_config.py takes the same arguments as ./easy-env-config.py and
+# import easy_env_config gives you the program itself as a module
+import importlib.util
+import os
+import sys
+
+_SOURCE = os.path.join(os.path.dirname(
+    os.path.realpath(__file__)), 'easy-env-config.py')
+
+
+def _load(name):
+    spec = importlib.util.spec_from_file_location(name, _SOURCE)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+if __name__ == '__main__':
+    _load('easy_env_config').main(sys.argv[1:])
+else:
+    # replaces this launcher in sys.modules, so the import returns the program
+    _load(__name__)